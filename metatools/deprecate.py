@@ -1,11 +1,39 @@
+"""Tools for renaming and deprecating things without breaking their users.
+
+Every use of a deprecated thing issues a warning. If that is too much (e.g.
+for a renamed attribute used in a hot loop), set ``METATOOLS_DEPRECATE_ONCE``
+and they are only issued the first time each call site uses each thing; after
+that, a use costs little more than a set lookup.
+
+"""
+
 import functools
+import os
 import sys
 import warnings
+import weakref
 
 
 from .imports import resolve_relative_name
 
 
+_ONCE = bool(os.environ.get('METATOOLS_DEPRECATE_ONCE', ''))
+
+# The (code, lineno, symbol) of every use already warned about; see _first_report.
+_reported = set()
+
+
+def _first_report(symbol, stacklevel):
+    """Is this the first time the caller (``stacklevel`` frames up, as for
+    :func:`warnings.warn`) has used the given symbol?"""
+    frame = sys._getframe(stacklevel)
+    key = (frame.f_code, frame.f_lineno, symbol)
+    if key in _reported:
+        return False
+    _reported.add(key)
+    return True
+
+
 class CallingDeprecatedWarning(UserWarning):
     pass
 
@@ -27,7 +55,8 @@ class renamed_attr(object):
     """Proxy for renamed attributes (or methods) on classes.
 
     Getting and setting values will be redirected to the provided name,
-    and warnings will be issues every time.
+    and warnings will be issued every time (or once per call site if
+    ``METATOOLS_DEPRECATE_ONCE`` is set).
 
     E.g.::
 
@@ -54,28 +83,39 @@ class renamed_attr(object):
 
     def __init__(self, new_name):
         self.new_name = new_name
-        self._old_name = None # We haven't discovered it yet.
-
-    def old_name(self, cls):
-        if self._old_name is None:
-            for k, v in vars(cls).iteritems():
+        # Maps classes to (old_name, message), as we discover them.
+        self._descriptions = weakref.WeakKeyDictionary()
+
+    def _describe(self, cls):
+        try:
+            return self._descriptions[cls]
+        except KeyError:
+            pass
+        old_name = None
+        for base in getattr(cls, '__mro__', (cls, )):
+            for k, v in vars(base).iteritems():
                 if v is self:
-                    self._old_name = k
+                    old_name = k
                     break
-        return self._old_name
+            if old_name is not None:
+                break
+        description = self._descriptions[cls] = (
+            old_name,
+            '%s.%s was renamed to %s' % (cls.__name__, old_name, self.new_name),
+        )
+        return description
+
+    def old_name(self, cls):
+        return self._describe(cls)[0]
 
     def __get__(self, instance, cls):
-        old_name = self.old_name(cls)
-        warnings.warn('%s.%s was renamed to %s' % (
-            cls.__name__, old_name, self.new_name,
-        ), AttributeRenamedWarning, stacklevel=2)
+        if not _ONCE or _first_report(self, 2):
+            warnings.warn(self._describe(cls)[1], AttributeRenamedWarning, stacklevel=2)
         return getattr(instance if instance is not None else cls, self.new_name)
 
     def __set__(self, instance, value):
-        old_name = self.old_name(instance.__class__)
-        warnings.warn('%s.%s was renamed to %s' % (
-            instance.__class__.__name__, old_name, self.new_name,
-        ), AttributeRenamedWarning, stacklevel=2)
+        if not _ONCE or _first_report(self, 2):
+            warnings.warn(self._describe(instance.__class__)[1], AttributeRenamedWarning, stacklevel=2)
         setattr(instance, self.new_name, value)
 
 
@@ -105,19 +145,14 @@ def renamed_func(func, name=None, module=None):
             full_name = '%s.%s' % (module, name)
         else:
             full_name = name
+        message = '%s was renamed to %s.%s' % (full_name, func.__module__, func.__name__)
     else:
-        full_name = None
+        message = 'renamed to %s.%s' % (func.__module__, func.__name__)
 
     @functools.wraps(func)
     def _wrapper(*args, **kwargs):
-        if full_name is not None:
-            warnings.warn('%s was renamed to %s.%s' % (
-                full_name, func.__module__, func.__name__,
-            ), FunctionRenamedWarning, stacklevel=2)
-        else:
-            warnings.warn('renamed to %s.%s' % (
-                func.__module__, func.__name__,
-            ), FunctionRenamedWarning, stacklevel=2)
+        if not _ONCE or _first_report(_wrapper, 2):
+            warnings.warn(message, FunctionRenamedWarning, stacklevel=2)
         return func(*args, **kwargs)
 
     if name:
@@ -186,11 +221,12 @@ def deprecate(func):
 
     """
 
+    message = '%s.%s has been deprecated' % (func.__module__, func.__name__)
+
     @functools.wraps(func)
     def _wrapped(*args, **kwargs):
-        warnings.warn('%s.%s has been deprecated' % (
-            func.__module__, func.__name__,
-        ), CallingDeprecatedWarning, stacklevel=2)
+        if not _ONCE or _first_report(_wrapped, 2):
+            warnings.warn(message, CallingDeprecatedWarning, stacklevel=2)
         return func(*args, **kwargs)
 
     return _wrapped
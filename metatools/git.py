@@ -0,0 +1,161 @@
+"""Reading many files out of a git repository quickly.
+
+Hooks and CI tools need the contents of every changed file in a push, and
+running ``git cat-file`` once per file (or ``os.walk``-ing a checkout) is what
+makes them slow. :class:`BlobReader` keeps one ``git cat-file --batch``
+process running and pipelines requests to it::
+
+    >>> with BlobReader() as reader:
+    ...     for path in changed_paths('HEAD~10', 'HEAD'):
+    ...         source = reader.read('HEAD:' + path)
+
+"""
+
+import subprocess
+
+
+# The hash of the empty tree, for diffing against commits with no parents.
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+# What a ref is pushed from/to when created/deleted.
+NULL_SHA = '0' * 40
+
+
+def _git(args, repo=None, git='git'):
+    proc = subprocess.Popen([git] + list(args), cwd=repo, stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, ' '.join([git] + list(args)))
+    return out
+
+
+def parse_range(spec):
+    """Split a revision range into ``(old, new)``.
+
+    ``"A..B"`` is the changes from A to B, and just ``"A"`` is the changes
+    introduced by the commit A.
+
+    """
+    if '..' in spec:
+        old, new = spec.split('..', 1)
+        return old or 'HEAD', new or 'HEAD'
+    return spec + '^', spec
+
+
+def changed_paths(old, new, repo=None, git='git'):
+    """Get the paths of the files added or modified between two revisions.
+
+    ``old`` may be :data:`NULL_SHA` (as given to hooks for new refs), in which
+    case every file in ``new`` is considered changed.
+
+    :returns: A sorted list of paths, relative to the root of the repository.
+
+    """
+    if old == NULL_SHA:
+        old = EMPTY_TREE
+    out = _git(['diff', '--name-only', '--no-renames', '--diff-filter=ACMT', '-z', old, new], repo, git)
+    return sorted(x for x in out.split('\0') if x)
+
+
+def list_paths(rev, repo=None, git='git'):
+    """Get the paths of every file in the given revision, from the root of the repository."""
+    out = _git(['ls-tree', '-r', '--full-tree', '--name-only', '-z', rev], repo, git)
+    return [x for x in out.split('\0') if x]
+
+
+class BlobReader(object):
+
+    """Reads objects via one long-lived ``git cat-file --batch`` process.
+
+    Objects are named as for ``git cat-file``, e.g. ``"HEAD:path/to/file.py"``
+    or a SHA. The process is started on first use, and stopped by
+    :meth:`close` (or leaving a ``with`` block).
+
+    :param str repo: The repository (or a directory within its working copy)
+        to read from; the current directory by default.
+    :param int batch_size: How many requests to send before reading their
+        responses; bounded so that neither pipe can fill up and deadlock.
+
+    """
+
+    def __init__(self, repo=None, git='git', batch_size=64):
+        self.repo = repo
+        self.git = git
+        self.batch_size = batch_size
+        self._proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_proc(self):
+        if self._proc is None:
+            self._proc = subprocess.Popen(
+                [self.git, 'cat-file', '--batch'],
+                cwd=self.repo,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        return self._proc
+
+    def read(self, name):
+        """Get the contents of the given object, or ``None`` if it doesn't exist."""
+        for _, content in self.read_many([name]):
+            return content
+
+    def read_many(self, names):
+        """Get the contents of many objects.
+
+        :returns: An iterator of ``(name, content)``, in the order given;
+            ``content`` is ``None`` for those which don't exist.
+
+        """
+
+        proc = self._get_proc()
+
+        names = iter(names)
+        while True:
+
+            batch = []
+            for name in names:
+                if '\n' in name:
+                    raise ValueError('object names cannot contain newlines; %r' % name)
+                batch.append(name)
+                if len(batch) >= self.batch_size:
+                    break
+            if not batch:
+                return
+
+            proc.stdin.write(''.join(x + '\n' for x in batch))
+            proc.stdin.flush()
+
+            for i, name in enumerate(batch):
+                content = self._read_response(proc)
+                try:
+                    yield name, content
+                except GeneratorExit:
+                    # Keep the responses in sync for the next caller.
+                    for _ in batch[i + 1:]:
+                        self._read_response(proc)
+                    raise
+
+    def _read_response(self, proc):
+        header = proc.stdout.readline()
+        if not header:
+            raise IOError('git cat-file exited unexpectedly')
+        # Either "<sha> <type> <size>", or "<name> missing" (or "ambiguous").
+        parts = header.split()
+        if parts[-1] in ('missing', 'ambiguous'):
+            return None
+        size = int(parts[2])
+        content = proc.stdout.read(size)
+        proc.stdout.read(1) # The trailing newline.
+        return content
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
@@ -0,0 +1,182 @@
+"""A persistent cache of the imports discovered in source files.
+
+Parsing every module is the bulk of the work in discovering dependencies, and
+the results only change when the file does. This cache stores the raw (before
+resolving relative names) results of :func:`~metatools.imports.discovery.parse_imports`
+in a small SQLite database, keyed by the file's path, size, modification time,
+and inode. The database is emptied whenever it was written by a different
+:data:`PARSER_VERSION`.
+
+The cache is only used when enabled, either by setting ``METATOOLS_IMPORT_CACHE``
+to the path of the database, or via :func:`set_import_cache`.
+
+Many processes may share one cache; SQLite handles the locking, and any
+problems with the database (e.g. it being locked for too long) are treated as a
+miss instead of an error. The number of entries is bounded (by
+``METATOOLS_IMPORT_CACHE_SIZE``, or the ``max_entries`` argument), and the
+oldest writes are evicted first.
+
+"""
+
+import os
+import sqlite3
+import threading
+
+
+# Bump this whenever the output of discovery.parse_imports changes, to
+# invalidate caches.
+PARSER_VERSION = 2
+
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS imports (
+        path TEXT NOT NULL,
+        deep INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        names TEXT NOT NULL,
+        PRIMARY KEY (path, deep)
+    )
+'''
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return st.st_size, int(st.st_mtime * 1e9), st.st_ino
+
+
+class ImportCache(object):
+
+    """A persistent mapping of source files to the names they import.
+
+    :param str path: The SQLite database to use; created if needed.
+    :param int max_entries: Maximum number of entries to retain.
+    :param float timeout: Seconds to wait on a locked database before giving up.
+
+    """
+
+    def __init__(self, path, max_entries=None, timeout=1.0):
+
+        self.path = path
+        self.max_entries = int(max_entries or os.environ.get('METATOOLS_IMPORT_CACHE_SIZE') or 100000)
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+
+    def _connect(self):
+
+        # Connections can't be shared across a fork.
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        dir_ = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(dir_):
+            try:
+                os.makedirs(dir_)
+            except OSError:
+                # Another process may have just made it.
+                if not os.path.exists(dir_):
+                    raise
+
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        conn.text_factory = str
+        with conn:
+            conn.execute(_SCHEMA)
+            # Drop everything parsed by another version.
+            if conn.execute('PRAGMA user_version').fetchone()[0] != PARSER_VERSION:
+                conn.execute('DELETE FROM imports')
+                conn.execute('PRAGMA user_version = %d' % PARSER_VERSION)
+
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def get(self, path, deep=False):
+        """Get the cached imports of the given file.
+
+        :returns: The list of names, or ``None`` if not cached.
+
+        """
+        try:
+            key = _stat_key(path)
+        except OSError:
+            return
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT size, mtime, inode, names FROM imports WHERE path = ? AND deep = ?',
+                    (path, int(deep)),
+                ).fetchone()
+        except sqlite3.Error:
+            return
+        if row is None or tuple(row[:3]) != key:
+            return
+        return row[3].split('\n') if row[3] else []
+
+    def set(self, path, deep, names, key=None):
+        """Store the imports of the given file.
+
+        :param key: The result of ``_stat_key(path)``, taken before the file was
+            read; the file is stat-ed now if not given.
+
+        """
+        try:
+            size, mtime, inode = key or _stat_key(path)
+        except OSError:
+            return
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO imports (path, deep, size, mtime, inode, names) VALUES (?, ?, ?, ?, ?, ?)',
+                        (path, int(deep), size, mtime, inode, '\n'.join(names)),
+                    )
+                self._writes += 1
+                if self._writes % 100 == 1:
+                    self._evict(conn)
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, conn):
+        count = conn.execute('SELECT count(*) FROM imports').fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            with conn:
+                conn.execute(
+                    'DELETE FROM imports WHERE rowid IN (SELECT rowid FROM imports ORDER BY rowid LIMIT ?)',
+                    (excess, ),
+                )
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('DELETE FROM imports')
+
+
+_import_cache = None
+_import_cache_loaded = False
+
+
+def get_import_cache():
+    """Get the :class:`ImportCache` in use, or ``None`` if caching is disabled."""
+    global _import_cache, _import_cache_loaded
+    if not _import_cache_loaded:
+        path = os.environ.get('METATOOLS_IMPORT_CACHE')
+        _import_cache = ImportCache(os.path.expanduser(path)) if path else None
+        _import_cache_loaded = True
+    return _import_cache
+
+
+def set_import_cache(cache):
+    """Set the :class:`ImportCache` to use (or a path to one), or ``None`` to disable caching."""
+    global _import_cache, _import_cache_loaded
+    if isinstance(cache, basestring):
+        cache = ImportCache(cache)
+    _import_cache = cache
+    _import_cache_loaded = True
@@ -1,8 +1,10 @@
 import os
 import ast
+import bisect
 import re
 
 from . import utils
+from .cache import get_import_cache, _stat_key
 
 
 def get_top_level_imports(module):
@@ -21,14 +23,40 @@ def get_top_level_imports(module):
     if os.path.splitext(path)[1] != '.py':
         return []
 
-    return parse_imports(
-        open(path).read(),
+    return parse_file_imports(
+        path,
         getattr(module, '__package__'),
         getattr(module, '__name__'),
-        path=path,
     )
 
 
+def parse_file_imports(path, package=None, module=None, deep=False):
+    """Get the imports in the given Python file.
+
+    This is :func:`parse_imports` for files, and will use the persistent
+    :class:`~metatools.imports.cache.ImportCache` if it is enabled.
+
+    :param str path: The Python file to parse.
+    :param str package: The ``__package__`` this source is from.
+    :param str module: The ``__name__`` this source is from.
+    :param bool deep: Walk the full AST, or only look at the top-level?
+    :returns list: The names of everything imported; absolute if package
+        and module are provided.
+
+    """
+
+    cache = get_import_cache()
+    names = cache.get(path, deep) if cache is not None else None
+
+    if names is None:
+        key = _stat_key(path) if cache is not None else None
+        names = parse_imports(open(path).read(), path=path, deep=deep)
+        if cache is not None:
+            cache.set(path, deep, names, key)
+
+    return _resolve_names(names, package, module)
+
+
 def parse_imports(source, package=None, module=None, path=None, deep=False):
     """Get the imports in the given Python source code.
 
@@ -39,20 +67,33 @@ def parse_imports(source, package=None, module=None, path=None, deep=False):
     :returns list: The names of everything imported; absolute if package
         and module are provided.
 
+    Only the top-level import statements are parsed if that is all that is
+    needed, unless they can't be reliably found without parsing everything.
+
     """
 
-    names = []
+    nodes = None
+    if not deep:
+        try:
+            nodes = _find_top_level_imports(source)
+        except _Ambiguous:
+            pass
 
-    try:
-        # Discard all trailing whitespace to avoid syntax errors due to
-        # too much white in the last line.
-        mod_ast = ast.parse(source.rstrip())
-    except (TypeError, SyntaxError) as e:
-        # TODO: should this be a warning?
-        print '# %s: %s in %s: %s' % (__name__, e.__class__.__name__, path, e)
-        return []
+    if nodes is None:
+
+        try:
+            # Discard all trailing whitespace to avoid syntax errors due to
+            # too much white in the last line.
+            mod_ast = ast.parse(source.rstrip())
+        except (TypeError, SyntaxError) as e:
+            # TODO: should this be a warning?
+            print '# %s: %s in %s: %s' % (__name__, e.__class__.__name__, path, e)
+            return []
 
-    for node in ast.walk(mod_ast) if deep else mod_ast.body:
+        nodes = ast.walk(mod_ast) if deep else mod_ast.body
+
+    names = []
+    for node in nodes:
         if isinstance(node, ast.Import):
             names.extend(alias.name for alias in node.names)
         elif isinstance(node, ast.ImportFrom):
@@ -62,12 +103,137 @@ def parse_imports(source, package=None, module=None, path=None, deep=False):
                 base += '.'
             names.extend(base + alias.name for alias in node.names)
 
+    return _resolve_names(names, package, module)
+
+
+class _Ambiguous(ValueError):
+    pass
+
+
+_string_or_comment_re = re.compile(r'''
+    \#[^\n]*
+  | [uUbB]?[rR]?(?:
+        \'\'\'(?:\\.|[^\\])*?\'\'\'
+      | """(?:\\.|[^\\])*?"""
+      | '(?:\\.|[^'\\\n])*'
+      | "(?:\\.|[^"\\\n])*"
+    )
+''', re.X | re.S)
+
+_top_level_import_re = re.compile(r'^(?:import|from)\b', re.M)
+_inline_import_re = re.compile(r';[ \t]*(?:import|from)\b')
+
+
+def _find_top_level_imports(source):
+    """Find the top-level import statements without parsing the whole source.
+
+    Top-level statements must start in the first column, and ``import`` and
+    ``from`` can't start a line in the middle of an expression, so any line
+    which starts with them (and is not within a string) is an import
+    statement. We parse only those.
+
+    :returns list: The ``ast`` nodes of the import statements.
+    :raises _Ambiguous: when we can't be sure.
+
+    """
+
+    # Imports after a semicolon don't start a line.
+    if _inline_import_re.search(source):
+        raise _Ambiguous('import after semicolon')
+
+    starts = [m.start() for m in _top_level_import_re.finditer(source)]
+    if not starts:
+        return []
+
+    # Find the spans of strings which contain newlines, since lines within
+    # them may appear to be imports.
+    string_starts = []
+    string_ends = []
+    for m in _string_or_comment_re.finditer(source):
+        if '\n' in m.group(0):
+            string_starts.append(m.start())
+            string_ends.append(m.end())
+
+    nodes = []
+    for start in starts:
+
+        i = bisect.bisect_right(string_starts, start) - 1
+        if i >= 0 and string_ends[i] > start:
+            continue
+
+        # Extend to the end of the statement (via parenthesis or backslashes).
+        end = start
+        depth = 0
+        while True:
+            line_end = source.find('\n', end)
+            if line_end < 0:
+                line_end = len(source)
+            code = source[end:line_end].split('#', 1)[0].rstrip()
+            depth += code.count('(') - code.count(')')
+            end = line_end + 1
+            if end >= len(source) or (depth <= 0 and not code.endswith('\\')):
+                break
+
+        try:
+            body = ast.parse(source[start:end]).body
+        except (TypeError, SyntaxError):
+            raise _Ambiguous('could not parse statement')
+        if len(body) != 1 or not isinstance(body[0], (ast.Import, ast.ImportFrom)):
+            raise _Ambiguous('not a single import statement')
+        nodes.append(body[0])
+
+    return nodes
+
+
+def _resolve_names(names, package, module):
     if package is not None and module is not None:
         names = [utils.resolve_relative_name(package, module, name) for name in names]
-
     return names
 
 
+def _split_path(path):
+    return [x for x in os.path.abspath(path).split(os.path.sep) if x]
+
+
+class DirectoryIndex(object):
+
+    """A set of directories, for quickly testing if paths are within any of them.
+
+    This is a trie of path components, so testing a path costs as much as
+    its depth, regardless of how many directories there are.
+
+    :param list directories: The directories to start with.
+
+    """
+
+    def __init__(self, directories=()):
+        self._root = {}
+        for dir_ in directories:
+            self.add(dir_)
+
+    def add(self, directory):
+        node = self._root
+        for part in _split_path(directory):
+            # Already covered by a parent directory.
+            if None in node:
+                return
+            node = node.setdefault(part, {})
+        node.clear()
+        node[None] = True
+
+    def __contains__(self, path):
+        node = self._root
+        if None in node:
+            return True
+        for part in _split_path(path):
+            node = node.get(part)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
 def path_is_in_directories(path, directories):
     """Is the given path within the given directories?
 
@@ -75,17 +241,8 @@ def path_is_in_directories(path, directories):
     :param list directories: The directories to test if the path is in.
     :returns bool:
 
-    """
-    path = os.path.abspath(path)
-    directories = [os.path.abspath(x) for x in directories]
-    for dir_ in sorted(directories, key=len):
-        if dir_ == os.path.sep:
-            return True
-        if re.match('%s(%s|$)' % (
-            re.escape(dir_),
-            re.escape(os.path.sep)
-        ), path):
-            return True
-    return False
-
+    When testing many paths against the same directories, use a
+    :class:`DirectoryIndex` directly.
 
+    """
+    return path in DirectoryIndex(directories)
@@ -1,7 +1,47 @@
+"""Loading functions named by "entry point" strings.
+
+Resolved entry points are cached (in an LRU of ``METATOOLS_ENTRY_POINT_CACHE_SIZE``
+entries, 1024 by default; 0 disables it), so loading the same string again is
+little more than a dictionary lookup. A cached entry point is resolved again
+if its module has been reloaded by :func:`~metatools.imports.reload.reload`
+(or :func:`~metatools.imports.reload.autoreload`), or replaced in
+:data:`sys.modules`.
+
+Entry points may also be loaded lazily (with ``lazy=True``), in which case a
+:class:`LazyEntryPoint` stands in for them until they are first used, so that
+registering many of them costs no imports at all.
+
+Many entry points may be loaded at once by :func:`load_entry_points`, which
+imports each of their modules once, and reads the sources of everything they
+will import in parallel beforehand.
+
+"""
+
 import ast
+import collections
+import copy
+import functools
+import imp
+import multiprocessing.pool
+import os
 import re
+import sys
+import threading
+import weakref
+
+from . import discovery
+from .reload import autoreload, throttled_autoreload, _reload_times, _iter_components
+
+
+_CACHE_SIZE = int(os.environ.get('METATOOLS_ENTRY_POINT_CACHE_SIZE', '1024'))
+_PREFETCH_THREADS = int(os.environ.get('METATOOLS_ENTRY_POINT_THREADS', '8'))
+
+# Maps entry point strings to _EntryPoint; least recently used first.
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
 
-from .reload import autoreload
+# Every LazyEntryPoint which is still alive.
+_lazy_entry_points = weakref.WeakSet()
 
 
 class EntryPointMalformed(ValueError):
@@ -16,7 +56,220 @@ class EntryPointAttributeError(AttributeError):
 class EntryPointMalformedArgs(ValueError):
     pass
 
-def load_entry_point(entry_point, reload=False, with_args=False):
+
+_entry_point_re = re.compile(r'''
+    (\w+(?:\.\w+)*) # Module.
+    :
+    (\w+(?:\.\w+)*) # Attributes.
+    (?:\((
+        .+?         # Arguments.
+    )\))?$
+''', flags=re.VERBOSE)
+
+
+class _EntryPoint(object):
+
+    """A parsed entry point, and what it last resolved to."""
+
+    __slots__ = ('spec', 'module_name', 'attrs', 'args_source', 'args', 'resolved')
+
+    def __init__(self, spec):
+
+        m = _entry_point_re.match(spec)
+        if not m:
+            raise EntryPointMalformed("Malformed entry point.", spec)
+
+        self.spec = spec
+        self.module_name, attr_list, self.args_source = m.groups()
+        self.attrs = attr_list.split('.')
+
+        # (args, kwargs), parsed on first use.
+        self.args = None
+
+        # (module, reload_time, head, obj), from the last resolve; head is the
+        # module's attribute which the rest are looked up on.
+        self.resolved = None
+
+    def check_args(self, with_args):
+        if self.args_source and not with_args:
+            raise ValueError("Entry point has arguments, but they are not allowed in this context.", self.spec)
+
+    def import_module(self):
+        try:
+            return __import__(self.module_name, fromlist=['.'])
+        except ImportError as e:
+            raise EntryPointImportError(*e.args)
+
+    def resolve(self):
+
+        module = sys.modules.get(self.module_name)
+        reload_time = _reload_times.get(self.module_name)
+
+        # Still valid if the module has been neither reloaded nor replaced, and
+        # its attribute still holds the same object (e.g. after the builtin
+        # reload, or monkeypatching).
+        resolved = self.resolved
+        if (
+            module is not None and resolved is not None and resolved[0] is module and
+            resolved[1] == reload_time and getattr(module, self.attrs[0], resolved) is resolved[2]
+        ):
+            return resolved[3]
+
+        if module is None:
+            module = self.import_module()
+
+        obj = module
+        for i, attr in enumerate(self.attrs):
+            try:
+                obj = getattr(obj, attr)
+            except AttributeError as e:
+                raise EntryPointAttributeError(*e.args)
+            if not i:
+                head = obj
+
+        # Assigned at once, so other threads never see a partial result.
+        self.resolved = (module, reload_time, head, obj)
+        return obj
+
+    def get_args(self):
+
+        if self.args is None:
+            self.args = self.parse_args()
+
+        # Deep copies, so that callers may modify them (and their contents).
+        return copy.deepcopy(self.args)
+
+    def parse_args(self):
+
+        if not self.args_source:
+            return (), {}
+
+        module = ast.parse('__capture__({})'.format(self.args_source))
+        if not isinstance(module, ast.Module):
+            raise EntryPointMalformedArgs("Malformed entry point arguments; not a module.", self.spec)
+        if len(module.body) != 1:
+            raise EntryPointMalformedArgs("Malformed entry point arguments; too many statements.", self.spec)
+
+        call_ = module.body[0].value
+        if not isinstance(call_, ast.Call):
+            raise EntryPointMalformedArgs("Malformed entry point arguments; not a call.", self.spec)
+
+        try:
+            args = [ast.literal_eval(arg) for arg in call_.args]
+        except ValueError as e:
+            raise EntryPointMalformedArgs("Malformed entry point arguments; malformed arg.", self.spec)
+
+        try:
+            kwargs = {kwarg.arg: ast.literal_eval(kwarg.value) for kwarg in call_.keywords}
+        except ValueError as e:
+            raise EntryPointMalformedArgs("Malformed entry point arguments; malformed kwarg.", self.spec)
+
+        return args, kwargs
+
+
+def _get_entry_point(spec):
+
+    if not _CACHE_SIZE:
+        return _EntryPoint(spec)
+
+    with _cache_lock:
+        entry = _cache.pop(spec, None)
+        if entry is not None:
+            _cache[spec] = entry
+            return entry
+
+    entry = _EntryPoint(spec)
+    with _cache_lock:
+        _cache[spec] = entry
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return entry
+
+
+def clear_cache():
+    """Forget every entry point loaded by :func:`load_entry_point`."""
+    with _cache_lock:
+        _cache.clear()
+
+
+class LazyEntryPoint(object):
+
+    """Stands in for an entry point until it is first called, or has an
+    attribute accessed, at which point it is loaded.
+
+    These are returned by :func:`load_entry_point` with ``lazy=True``. The
+    entry point is only loaded once, after which the proxy passes everything
+    through to it.
+
+    """
+
+    __slots__ = ('_lazy_spec', '_lazy_reload', '_lazy_target', '_lazy_touched', '__weakref__')
+
+    def __init__(self, spec, reload=False):
+        self._lazy_spec = spec
+        self._lazy_reload = reload
+        self._lazy_target = None
+        self._lazy_touched = False
+        _lazy_entry_points.add(self)
+
+    def __repr__(self):
+        return '<%s %r%s>' % (self.__class__.__name__, self._lazy_spec, ' (loaded)' if self._lazy_target else '')
+
+    def _lazy_resolve(self):
+        target = self._lazy_target
+        if target is None:
+            # Wrapped so that we can tell a loaded None from an unloaded one.
+            target = self._lazy_target = (load_entry_point(self._lazy_spec, reload=self._lazy_reload), )
+        return target[0]
+
+    def __call__(self, *args, **kwargs):
+        self._lazy_touched = True
+        return self._lazy_resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        self._lazy_touched = True
+        return getattr(self._lazy_resolve(), name)
+
+
+def resolve_lazy_entry_points(proxies=None):
+    """Load lazy entry points now, e.g. to validate them all at startup.
+
+    This does not count as using them (see :func:`iter_untouched_entry_points`).
+
+    :param proxies: The :class:`LazyEntryPoint` objects to load; by default all
+        of them which haven't been loaded.
+    :returns: A dict mapping the spec of those which failed to the exception.
+
+    """
+
+    if proxies is None:
+        proxies = [x for x in list(_lazy_entry_points) if x._lazy_target is None]
+
+    # Import everything in bulk first; the proxies then hit the cache.
+    load_entry_points([x._lazy_spec for x in proxies])
+
+    errors = {}
+    for proxy in proxies:
+        try:
+            proxy._lazy_resolve()
+        except Exception as e:
+            errors[proxy._lazy_spec] = e
+    return errors
+
+
+def iter_untouched_entry_points():
+    """Iterate over the specs of the lazy entry points which are still
+    alive but have never been used, in no particular order.
+
+    This is to find what a process registers but does not need.
+
+    """
+    for proxy in list(_lazy_entry_points):
+        if not proxy._lazy_touched:
+            yield proxy._lazy_spec
+
+
+def load_entry_point(entry_point, reload=False, with_args=False, lazy=False):
     """Load a function as defined by an "entry point" string.
 
     Entry point strings look like:
@@ -27,90 +280,230 @@ def load_entry_point(entry_point, reload=False, with_args=False):
 
     :param str entry_point: The string to parse.
     :param bool reload: If the module should be reloaded by :func:`autoreload`;
-        ``None`` implies automatic.
+        ``None`` implies automatic (via :func:`throttled_autoreload`, so it
+        is cheap to call in a loop).
     :param bool with_args: If arguments are allowed in the string; this
         changes the return signature.
+    :param bool lazy: Return a :class:`LazyEntryPoint` which loads the entry
+        point when it is first used; only malformed strings raise errors now.
 
     :returns: ``func`` or ``(func, args, kwargs)`` if ``with_args``.
+        The result is cached until the module is reloaded or
+        replaced, or its attribute named first in the entry point is
+        reassigned; reassigning deeper attributes (e.g. the ``method`` of
+        ``module:Class.method``) is not noticed.
     :raises: ``EntryPointImportError`` if the module doesn't exist,
         ``EntryPointAttributeError`` if the attributes don't exit.
 
     """
 
-    m = re.match(r'''
-        (\w+(?:\.\w+)*) # Module.
-        :
-        (\w+(?:\.\w+)*) # Attributes.
-        (?:\((
-            .+?         # Arguments.
-        )\))?$
-    ''', entry_point, flags=re.VERBOSE)
-
-    if not m:
-        raise EntryPointMalformed("Malformed entry point.", entry_point)
-
-    module_name, attr_list, args_source = m.groups()
+    entry = _get_entry_point(entry_point)
 
-    if args_source and not with_args:
-        raise ValueError("Entry point has arguments, but they are not allowed in this context.", entry_point)
+    entry.check_args(with_args)
 
-    try:
-        module = __import__(module_name, fromlist=['.'])
-    except ImportError as e:
-        raise EntryPointImportError(*e.args)
+    if lazy:
+        # The arguments are part of the entry point, not of what it names.
+        obj = LazyEntryPoint(entry_point.split('(', 1)[0], reload)
+        if not with_args:
+            return obj
+        args, kwargs = entry.get_args()
+        return obj, args, kwargs
 
     # Reload if requested. `reload is None` is automatic. `reload is True`
     # will always reload the direct module.
-    if reload or reload is None:
-        autoreload(module, force_self=bool(reload))
-    
-    # Grab the attribute.
-    obj = module
-    for attr in attr_list.split('.'):
-        try:
-            obj = getattr(obj, attr)
-        except AttributeError as e:
-            raise EntryPointAttributeError(*e.args)
+    if reload:
+        autoreload(sys.modules.get(entry.module_name) or entry.import_module(), force_self=True)
+    elif reload is None:
+        throttled_autoreload(sys.modules.get(entry.module_name) or entry.import_module())
+
+    obj = entry.resolve()
 
     if not with_args:
         return obj
 
-    # Loads args/kwargs.
-    if args_source:
+    args, kwargs = entry.get_args()
+    return obj, args, kwargs
 
-        module = ast.parse('__capture__({})'.format(args_source))
-        if not isinstance(module, ast.Module):
-            raise EntryPointMalformedArgs("Malformed entry point arguments; not a module.", entry_point)
-        if len(module.body) != 1:
-            raise EntryPointMalformedArgs("Malformed entry point arguments; too many statements.", entry_point)
 
-        call_ = module.body[0].value
-        if not isinstance(call_, ast.Call):
-            raise EntryPointMalformedArgs("Malformed entry point arguments; not a call.", entry_point)
+def _find_module(name, package_dirs):
+    """Find the file a module would be imported from, without importing it.
 
-        try:
-            args = [ast.literal_eval(arg) for arg in call_.args]
-        except ValueError as e:
-            raise EntryPointMalformedArgs("Malformed entry point arguments; malformed arg.", entry_point)
+    :param dict package_dirs: Maps the names of packages to their ``__path__``;
+        this is filled in as they are found.
+    :returns: ``(path, is_package)``, or ``None`` if it isn't Python.
+
+    """
+
+    parent, _, base = name.rpartition('.')
+    search = None
+    if parent:
+        search = package_dirs.get(parent) or getattr(sys.modules.get(parent), '__path__', None)
+        if search is None:
+            found = _find_module(parent, package_dirs)
+            if not found or not found[1]:
+                return
+            search = package_dirs[parent]
+
+    try:
+        fh, path, (_, _, type_) = imp.find_module(base, search)
+    except ImportError:
+        return
+    if fh:
+        fh.close()
 
+    if type_ == imp.PKG_DIRECTORY:
+        package_dirs[name] = [path]
+        return os.path.join(path, '__init__.py'), True
+    if type_ in (imp.PY_SOURCE, imp.PY_COMPILED):
+        return path, False
+
+
+def _prefetch_module(name, package_dirs):
+    """Read what importing a module will read, so the OS has it cached.
+
+    :returns: The names the module imports, or ``None`` if it wasn't found.
+
+    """
+
+    found = _find_module(name, package_dirs)
+    if not found:
+        return
+
+    path, is_package = found
+    base = os.path.splitext(path)[0]
+
+    # The bytecode is what will actually be read (if it is up to date).
+    try:
+        with open(base + '.pyc', 'rb') as fh:
+            fh.read()
+    except IOError:
+        pass
+
+    if not os.path.exists(base + '.py'):
+        return []
+    package = name if is_package else name.rpartition('.')[0]
+    try:
+        return discovery.parse_file_imports(base + '.py', package or None, name)
+    except (IOError, ValueError):
+        return []
+
+
+def _prefetch_imports(names, threads):
+    """Read the sources of the given modules, and all that they import.
+
+    :returns: The names in the order that they should be imported; dependencies
+        first.
+
+    """
+
+    names = sorted(set(names))
+
+    wave = [x for x in names if x not in sys.modules]
+    if threads <= 1 or not wave:
+        return names
+
+    # Maps the names of every module seen to those it imports.
+    edges = dict((x, []) for x in names)
+
+    package_dirs = {}
+    pool = multiprocessing.pool.ThreadPool(min(threads, len(wave)))
+    try:
+
+        # Breadth first, since we only know what to read next after parsing.
+        while wave:
+            for name in wave:
+                edges.setdefault(name, [])
+            next_wave = set()
+            for name, imports in zip(wave, pool.map(functools.partial(_prefetch_module, package_dirs=package_dirs), wave)):
+                if imports is None:
+                    continue
+                # Importing a module imports its package too.
+                if '.' in name:
+                    imports = [name.rpartition('.')[0]] + imports
+                edges[name] = imports
+                next_wave.update(x for x in imports if x not in edges and x not in sys.modules)
+            wave = sorted(next_wave)
+
+    finally:
+        pool.close()
+
+    # Drop the names that weren't modules (e.g. "from module import func").
+    for name, imports in edges.iteritems():
+        edges[name] = [x for x in imports if x in edges]
+
+    targets = set(names)
+    edges[None] = names
+    order = []
+    for component in _iter_components(None, edges):
+        order.extend(sorted(x for x in component if x in targets))
+    return order
+
+
+def load_entry_points(specs, reload=False, with_args=False, threads=None):
+    """Load many entry points at once, e.g. to validate a manifest of them.
+
+    Each module is imported only once, no matter how many of the entry points
+    it holds, and in dependency order. Before that, the files of those modules
+    and of everything that they import are read (and their imports parsed) in
+    a pool of threads, since on network filesystems importing is otherwise
+    dominated by latency. The imports themselves happen one at a time, as
+    the import lock requires.
+
+    :param specs: The entry point strings.
+    :param reload: As for :func:`load_entry_point`; applied once per module.
+    :param bool with_args: As for :func:`load_entry_point`.
+    :param int threads: How many threads to read files in;
+        ``METATOOLS_ENTRY_POINT_THREADS`` (or 8) by default, and 0 to skip it.
+    :returns: ``(results, errors)``; dicts mapping specs to what
+        :func:`load_entry_point` would have returned for them, or to the
+        exception it would have raised.
+
+    """
+
+    if threads is None:
+        threads = _PREFETCH_THREADS
+
+    results = {}
+    errors = {}
+
+    entries = {}
+    for spec in specs:
         try:
-            kwargs = {kwarg.arg: ast.literal_eval(kwarg.value) for kwarg in call_.keywords}
+            entry = _get_entry_point(spec)
+            entry.check_args(with_args)
         except ValueError as e:
-            raise EntryPointMalformedArgs("Malformed entry point arguments; malformed kwarg.", entry_point)
+            errors[spec] = e
+        else:
+            entries[spec] = entry
 
-    else:
-        args = ()
-        kwargs = {}
+    by_module = dict((x.module_name, x) for x in entries.itervalues())
+    module_errors = {}
+    for name in _prefetch_imports(by_module, threads):
+        try:
+            module = sys.modules.get(name) or by_module[name].import_module()
+            if reload:
+                autoreload(module, force_self=True)
+            elif reload is None:
+                throttled_autoreload(module)
+        except Exception as e:
+            module_errors[name] = e
+
+    for spec, entry in entries.iteritems():
+        if entry.module_name in module_errors:
+            errors[spec] = module_errors[entry.module_name]
+            continue
+        try:
+            obj = entry.resolve()
+            results[spec] = (obj, ) + entry.get_args() if with_args else obj
+        except Exception as e:
+            errors[spec] = e
 
-    return obj, args, kwargs
+    return results, errors
 
 
 if __name__ == '__main__':
 
-    import sys
-
     for spec in sys.argv[1:]:
         func, kwargs, args = load_entry_point(spec, with_args=True)
         print func, kwargs, args
 
-
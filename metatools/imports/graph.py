@@ -2,23 +2,60 @@ import os
 import sys
 import optparse
 import fnmatch
+import itertools
+import multiprocessing
 
-from .discovery import parse_imports
+from .cache import set_import_cache
+from .discovery import parse_file_imports
 from .utils import get_name_for_path
 
 
-def iter_modules(root):
+def iter_paths(root):
+    """Iterate over all Python files within the given directory, in sorted order."""
     for dir_name, dir_names, file_names in os.walk(root):
-        module_paths = [os.path.join(dir_name, x) for x in file_names if x.endswith('.py')]
-        for path in module_paths:
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if file_name.endswith('.py'):
+                yield os.path.join(dir_name, file_name)
 
-            module = get_name_for_path(path)
-            package = module.rsplit('.', 1)[0]
 
-            if module.rsplit('.', 1)[-1] == '__init__':
-                module = package
+def get_module_for_path(path):
+    """Get the names of the module and package of the given file.
 
-            yield path, module, parse_imports(open(path).read(), package, module, path, deep=True)
+    :returns: ``(module, package)``
+
+    """
+
+    module = get_name_for_path(path)
+    package = module.rsplit('.', 1)[0]
+
+    if module.rsplit('.', 1)[-1] == '__init__':
+        module = package
+
+    return module, package
+
+
+def parse_path(path):
+    """Get the module name and deep imports of the given file.
+
+    :returns: ``(path, module, imports)``
+
+    """
+    module, package = get_module_for_path(path)
+    return path, module, parse_file_imports(path, package, module, deep=True)
+
+
+def iter_modules(root, pool=None):
+    """Iterate over ``(path, module, imports)`` for every module in the given root.
+
+    :param pool: A :class:`multiprocessing.Pool` to parse the files in; results
+        are still returned in order.
+
+    """
+    paths = iter_paths(root)
+    if pool is None:
+        return itertools.imap(parse_path, paths)
+    return pool.imap(parse_path, paths, chunksize=64)
 
 
 def iter_dot(opts, roots):
@@ -26,11 +63,17 @@ def iter_dot(opts, roots):
     # Parse everything.
     all_modules = {}
     packages = set()
-    for root in roots:
-        for path, module, imports in iter_modules(root):
-            all_modules[module] = set(imports)
-            if os.path.basename(path) == '__init__.py':
-                packages.add(module)
+    jobs = getattr(opts, 'jobs', None)
+    pool = multiprocessing.Pool(jobs) if jobs and jobs > 1 else None
+    try:
+        for root in roots:
+            for path, module, imports in iter_modules(root, pool):
+                all_modules[module] = set(imports)
+                if os.path.basename(path) == '__init__.py':
+                    packages.add(module)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
     # Filter them to exclude patterns.
     all_modules = dict(
@@ -48,7 +91,7 @@ def iter_dot(opts, roots):
     yield 'digraph {'
 
     levels = []
-    for module, imports in all_modules.iteritems():
+    for module, imports in sorted(all_modules.iteritems()):
 
         # Collect everything that is the same level.
         level = module.count('.')
@@ -60,7 +103,7 @@ def iter_dot(opts, roots):
         if module in packages and (imports or opts.implied):
             yield '\t"%s" [style=filled]' % module
 
-        for import_ in set(imports):
+        for import_ in sorted(imports):
 
             m_parts = module.split('.')
             i_parts = import_.split('.')
@@ -73,7 +116,7 @@ def iter_dot(opts, roots):
 
     # Parent links.
     if opts.implied:
-        for module, imports in all_modules.iteritems():
+        for module, imports in sorted(all_modules.iteritems()):
             parent = module.rsplit('.', 1)[0]
             if parent != module and parent not in imports and module not in all_modules.get(parent, []):
                 yield '\t"%s" -> "%s" [style=dotted]' % (parent, module)
@@ -85,13 +128,64 @@ def iter_dot(opts, roots):
     yield '}'
 
 
+def main_index(opts, args):
+
+    from .index import GraphIndex
+
+    command = args.pop(0) if args else None
+
+    if os.path.exists(opts.index):
+        index = GraphIndex.load(opts.index)
+    elif command == 'update':
+        index = GraphIndex()
+    else:
+        print >> sys.stderr, 'index %s does not exist; run update first' % opts.index
+        sys.exit(1)
+
+    if command == 'update':
+        pool = multiprocessing.Pool(opts.jobs) if opts.jobs and opts.jobs > 1 else None
+        try:
+            changed, removed = index.update(args or None, pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        index.save(opts.index)
+        print >> sys.stderr, '%d changed, %d removed, %d total' % (len(changed), len(removed), len(index.files))
+
+    elif command in ('importers', 'imports') and len(args) == 1:
+        for name in sorted(getattr(index, command)(args[0], transitive=not opts.direct)):
+            print name
+
+    elif command == 'path' and len(args) == 2:
+        path = index.shortest_path(*args)
+        if path is None:
+            print >> sys.stderr, 'no path from %s to %s' % tuple(args)
+            sys.exit(1)
+        print ' -> '.join(path)
+
+    else:
+        print >> sys.stderr, 'usage: --index PATH (update [root...] | importers NAME | imports NAME | path SRC DST)'
+        sys.exit(1)
+
+
 def main():
 
     optparser = optparse.OptionParser()
     optparser.add_option('-e', '--exclude', action='append')
     optparser.add_option('-x', '--explicit', action='store_false', dest='implied')
+    optparser.add_option('-c', '--cache', help='persistent import cache to use')
+    optparser.add_option('-j', '--jobs', type='int', help='number of processes to parse files in')
+    optparser.add_option('-i', '--index', help='persistent graph index to update or query')
+    optparser.add_option('-d', '--direct', action='store_true', help='only direct imports/importers')
     opts, args = optparser.parse_args()
 
+    if opts.cache:
+        set_import_cache(opts.cache)
+
+    if opts.index:
+        main_index(opts, args)
+        return
+
     print '\n'.join(iter_dot(opts, args))
 
 
@@ -0,0 +1,227 @@
+"""A persistent index of the import graph, for answering questions quickly.
+
+The index records every module found under a set of roots, what it imports,
+and the size, modification time and hash of its file. :meth:`GraphIndex.update`
+only re-parses files whose stat and hash have both changed, so keeping it up
+to date is cheap, and queries never touch the source at all.
+
+From the command line::
+
+    python -m metatools.imports.graph --index graph.idx update path/to/tools
+    python -m metatools.imports.graph --index graph.idx importers some.module
+    python -m metatools.imports.graph --index graph.idx imports some.module
+    python -m metatools.imports.graph --index graph.idx path some.module another.module
+
+"""
+
+import collections
+import hashlib
+import marshal
+import os
+
+from .discovery import parse_imports
+from .graph import iter_paths, get_module_for_path
+
+
+def _index_path(args):
+    """Read, hash, and (if the hash is new) parse a file; for :meth:`GraphIndex.update`.
+
+    The size is ``None`` if the file could not be read (e.g. it was removed).
+
+    """
+
+    path, old_digest = args
+
+    try:
+        st = os.stat(path)
+        source = open(path).read()
+    except (IOError, OSError):
+        return path, None, None, None, None
+    digest = hashlib.sha1(source).hexdigest()
+
+    if digest == old_digest:
+        return path, st.st_size, st.st_mtime, digest, None
+
+    module, package = get_module_for_path(path)
+    imports = parse_imports(source, package, module, path, deep=True)
+    return path, st.st_size, st.st_mtime, digest, (module, imports)
+
+
+def _is_within(path, directories):
+    """Is the given path within (at any depth) any of the given directories?"""
+    dir_name = os.path.dirname(path)
+    while dir_name:
+        if dir_name in directories:
+            return True
+        parent = os.path.dirname(dir_name)
+        if parent == dir_name:
+            break
+        dir_name = parent
+    return False
+
+
+def _get_packages(paths):
+    return set(os.path.dirname(x) for x in paths if os.path.basename(x) == '__init__.py')
+
+
+class GraphIndex(object):
+
+    """The import graph of everything within a set of roots.
+
+    :param list roots: The directories to index.
+
+    """
+
+    version = 1
+
+    def __init__(self, roots=()):
+        self.roots = list(roots)
+
+        # Maps paths to (size, mtime, digest, module, imports).
+        self.files = {}
+
+        self._forward = None
+        self._reverse = None
+
+    @classmethod
+    def load(cls, path):
+        """Load an index which was previously saved."""
+        with open(path, 'rb') as fh:
+            data = marshal.load(fh)
+        if data.get('version') != cls.version:
+            raise ValueError('unsupported index version %r' % data.get('version'))
+        index = cls(data['roots'])
+        index.files = data['files']
+        return index
+
+    def save(self, path):
+        """Save the index; this is atomic."""
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as fh:
+            marshal.dump({
+                'version': self.version,
+                'roots': self.roots,
+                'files': self.files,
+            }, fh)
+        os.rename(tmp_path, path)
+
+    def update(self, roots=None, pool=None):
+        """Bring the index up to date with the files on disk.
+
+        :param list roots: Replace the roots to index.
+        :param pool: A :class:`multiprocessing.Pool` to parse files in.
+        :returns: ``(changed, removed)`` lists of paths.
+
+        """
+
+        if roots is not None:
+            self.roots = list(roots)
+
+        paths = [path for root in self.roots for path in iter_paths(root)]
+        seen = set(paths)
+
+        # The names of (and relative imports in) everything within a
+        # directory change when it becomes, or stops being, a package.
+        renamed = _get_packages(paths).symmetric_difference(_get_packages(self.files))
+
+        todo = []
+        for path in paths:
+            entry = self.files.get(path)
+            if entry is not None:
+                if renamed and _is_within(path, renamed):
+                    todo.append((path, None))
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # Removed since the walk.
+                    seen.discard(path)
+                    continue
+                if entry[:2] == (st.st_size, st.st_mtime):
+                    continue
+            todo.append((path, entry[2] if entry else None))
+
+        changed = []
+        results = pool.imap(_index_path, todo, chunksize=16) if pool is not None else (_index_path(x) for x in todo)
+        for path, size, mtime, digest, parsed in results:
+            if size is None:
+                # Removed (or unreadable) since the walk.
+                seen.discard(path)
+            elif parsed is None:
+                # Only the stat changed.
+                entry = self.files[path]
+                self.files[path] = (size, mtime, digest, entry[3], entry[4])
+            else:
+                self.files[path] = (size, mtime, digest, parsed[0], parsed[1])
+                changed.append(path)
+
+        removed = sorted(set(self.files).difference(seen))
+        for path in removed:
+            del self.files[path]
+
+        if changed or removed:
+            self._forward = self._reverse = None
+
+        return changed, removed
+
+    def _get_edges(self):
+        if self._forward is None:
+            modules = set(entry[3] for entry in self.files.itervalues())
+            forward = collections.defaultdict(set)
+            reverse = collections.defaultdict(set)
+            for size, mtime, digest, module, imports in self.files.itervalues():
+                for name in imports:
+                    if name != module and name in modules:
+                        forward[module].add(name)
+                        reverse[name].add(module)
+            self._forward = forward
+            self._reverse = reverse
+        return self._forward, self._reverse
+
+    @property
+    def modules(self):
+        """The set of all module names in the index."""
+        return set(entry[3] for entry in self.files.itervalues())
+
+    def _walk(self, edges, name, transitive):
+        if not transitive:
+            return set(edges.get(name, ()))
+        found = set()
+        queue = collections.deque([name])
+        while queue:
+            for next_ in edges.get(queue.popleft(), ()):
+                if next_ not in found:
+                    found.add(next_)
+                    queue.append(next_)
+        found.discard(name)
+        return found
+
+    def importers(self, name, transitive=True):
+        """Get the names of all modules which import the given one."""
+        return self._walk(self._get_edges()[1], name, transitive)
+
+    def imports(self, name, transitive=True):
+        """Get the names of all modules which the given one imports."""
+        return self._walk(self._get_edges()[0], name, transitive)
+
+    def shortest_path(self, src, dst):
+        """Get the shortest chain of imports from one module to another.
+
+        :returns: A list of module names from ``src`` to ``dst``, or ``None``.
+
+        """
+        forward = self._get_edges()[0]
+        parents = {src: None}
+        queue = collections.deque([src])
+        while queue:
+            name = queue.popleft()
+            if name == dst:
+                path = []
+                while name is not None:
+                    path.append(name)
+                    name = parents[name]
+                return path[::-1]
+            for next_ in sorted(forward.get(name, ())):
+                if next_ not in parents:
+                    parents[next_] = name
+                    queue.append(next_)
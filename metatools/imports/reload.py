@@ -15,15 +15,13 @@ start of an autoreload cycle). Then, in another autoreload cycle, another
 module can see when it's dependencies changes by comparing its reload time with
 the dependency's. If a dependency was reloaded, then reload ourselves as well.
 
-This is not perfect, and it is known to cause numerous issues (e.g. circular
-imports cause some strange problems), however we have found that the problems
-it brings up are minor in comparison to the speed boost it tends to give us
-while in active development.
-
-A better algorithm would construct a full module graph (doing something about
-cycles), and iteratively expand the region that must be reloaded. It may cull
-those who have not changes, linearize the remaining dependencies and reload
-everything in a big chain.
+Each autoreload cycle constructs the full module graph reachable from the
+requested module, and collapses cycles into strongly connected components
+(which are always reloaded together). The components are visited in
+topological order (dependencies first), so a single pass marks every component
+which has changed, or which depends upon one that has, and everything that was
+marked is then reloaded in that same order. Nothing is reloaded twice, and
+nothing outside of the affected region is reloaded at all.
 
 The tricky part is since `module discovery <discovery>`_ does not reveal the
 actual intensions of the code, e.g.:
@@ -54,35 +52,188 @@ but all the dependancies that it is actually capable of, e.g.:
     "gui" -> "core"
     "gui" -> "utils"
 
-
-
+Since packages and their contents so often appear to import each other, the
+discovered graph is full of cycles; every module within one is treated as
+depending upon every other.
 
 """
 
 import __builtin__
+import multiprocessing.pool
 import os
 import sys
 import time
 
 from . import utils
 from . import discovery
+from . import trace
+from . import watch
 
 
 _VERBOSE = int(os.environ.get('METATOOLS_RELOAD_VERBOSITY', '0'))
+_TRACE = os.environ.get('METATOOLS_RELOAD_TRACE', '')
 _DEVELOP = bool(os.environ.get('METATOOLS_RELOAD_DEVELOP', ''))
+_WATCH = os.environ.get('METATOOLS_RELOAD_WATCH', '')
+_STAT_THREADS = int(os.environ.get('METATOOLS_RELOAD_STAT_THREADS', '8'))
+_INTERVAL = float(os.environ.get('METATOOLS_RELOAD_INTERVAL') or 0)
 
 # Memoization stores.
 _reload_times = {}
 _modification_times = {}
 _dependency_lists = {}
 
+# The optional watch.Watcher which tracks changes in the background.
+_watcher = None
+
+# The (key, index) of non-stdlib directories on the sys.path; see _get_sys_path_index.
+_sys_path_index = None
+
+# The thread pool for stat-ing many files at once; created when needed, and
+# again in forked children (since its threads don't exist there).
+_stat_pool = None
+_stat_pool_pid = None
+
+# Functions called with timings of everything we do; see add_listener.
+_listeners = []
+
+# Incremented by every reload; see throttled_autoreload.
+_reload_count = 0
+
+# Maps module names to the (time, watcher, generation, reload_count, covered)
+# when throttled_autoreload last checked them; "covered" is if the watcher
+# covered every file that the check looked at.
+_throttled_checks = {}
+
+# Incremented every time a file has to be stat-ed despite there being a
+# watcher (because it couldn't watch it); see throttled_autoreload.
+_unwatched_count = 0
+
 
 def __before_reload__():
-    return _reload_times, _modification_times, _dependency_lists
+    return _reload_times, _modification_times, _dependency_lists, _watcher, _stat_pool, _listeners, _reload_count, _throttled_checks, _stat_pool_pid
 
 def __after_reload__(state):
-    for src, dst in zip((_reload_times, _modification_times, _dependency_lists), state):
+    global _stat_pool, _stat_pool_pid, _reload_count
+    for src, dst in zip((_reload_times, _modification_times, _dependency_lists), state[:3]):
         dst.update(src)
+    if len(state) > 3:
+        use_watcher(state[3])
+    if len(state) > 8 and state[4] is not None and state[8] == os.getpid():
+        _stat_pool = state[4]
+        _stat_pool_pid = state[8]
+    if len(state) > 5:
+        _listeners[:] = state[5]
+    if len(state) > 7:
+        _reload_count = state[6]
+        _throttled_checks.update(state[7])
+
+
+def add_listener(listener):
+    """Register a function to be called with the timings of reloading.
+
+    The listener is called as ``listener(event, name, start, duration)``, where
+    ``name`` is that of the module, ``start`` is from :func:`time.time`, and
+    ``duration`` is in seconds. The events are:
+
+    - ``"cycle"``: a full call to :func:`autoreload`;
+    - ``"graph"``: building the module graph during a cycle;
+    - ``"stat"``: checking modification times of the whole graph;
+    - ``"dependencies"``: discovering the dependencies of one module;
+    - ``"outdated"``: checking if one module is outdated;
+    - ``"before_reload"``, ``"reload"``, and ``"after_reload"``: the steps
+      of reloading one module.
+
+    See :class:`~metatools.imports.trace.ChromeTrace` for a listener which
+    records them for viewing. One of those is added automatically if
+    ``METATOOLS_RELOAD_TRACE`` is set to the path it should save to (when
+    the process exits).
+
+    """
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """Unregister a function previously passed to :func:`add_listener`."""
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def _emit(event, name, start):
+    duration = time.time() - start
+    for listener in list(_listeners):
+        listener(event, name, start, duration)
+
+
+if _TRACE:
+    add_listener(trace.ChromeTrace(_TRACE))
+
+
+def use_watcher(backend='auto', **kwargs):
+    """Track changes to source files in the background.
+
+    Once a module's source has been seen by :func:`autoreload` or
+    :func:`is_outdated`, it will be watched for changes, and they will no
+    longer need to check the filesystem to see if it is outdated.
+
+    This is enabled at import time if ``METATOOLS_RELOAD_WATCH`` is set to the
+    name of a backend (or ``1`` for ``"auto"``).
+
+    :param backend: The name of a :mod:`~metatools.imports.watch` backend,
+        a :class:`~metatools.imports.watch.Watcher`, or ``None`` to stop watching.
+    :param kwargs: Passed to the watcher's constructor.
+    :returns: The watcher in use.
+
+    """
+
+    global _watcher
+
+    if isinstance(backend, basestring):
+        backend = watch.get_watcher(backend, **kwargs)
+
+    if _watcher is not None and _watcher is not backend:
+        _watcher.close()
+    _watcher = backend
+
+    return _watcher
+
+
+if _WATCH:
+    use_watcher('auto' if _WATCH == '1' else _WATCH)
+
+
+def _get_watcher():
+    """Get the watcher, unless it was inherited across a fork (since its
+    thread doesn't exist in this process); then everything is stat-ed."""
+    if _watcher is not None and _watcher.pid == os.getpid():
+        return _watcher
+
+
+def _get_sys_path_index():
+    """Get a :class:`~metatools.imports.discovery.DirectoryIndex` of everywhere
+    on the ``sys.path`` that is not the stdlib.
+
+    This is rebuilt only when the ``sys.path`` (or working directory) changes.
+
+    """
+
+    global _sys_path_index
+
+    key = (tuple(sys.path), os.getcwd())
+    if _sys_path_index is None or _sys_path_index[0] != key:
+
+        stdlib = os.path.dirname(os.path.__file__)
+        prefix_index = discovery.DirectoryIndex([sys.prefix])
+
+        index = discovery.DirectoryIndex()
+        for path in sys.path:
+            if path == stdlib or (path in prefix_index and 'site-packages' not in path):
+                continue
+            index.add(path)
+
+        _sys_path_index = key, index
+
+    return _sys_path_index[1]
 
 
 def _iter_dependencies(module, visited=None):
@@ -98,6 +249,8 @@ def _iter_dependencies(module, visited=None):
     dependencies = _dependency_lists.get(module.__name__)
     if dependencies is None:
 
+        start = time.time() if _listeners else None
+
         potential_dependencies = []
 
         module_path = utils.get_source_path(module)
@@ -117,14 +270,8 @@ def _iter_dependencies(module, visited=None):
         # related to us.
         if discovered_names:
 
-            module_import_path = [package_dir]
-
-            # Include anywhere on the sys.path that is not the stdlib
-            stdlib = os.path.dirname(os.path.__file__)
-            for path in sys.path:
-                if path == stdlib or (discovery.path_is_in_directories(path, [sys.prefix]) and 'site-packages' not in path):
-                    continue
-                module_import_path.append(path)
+            sys_path_index = _get_sys_path_index()
+            package_index = discovery.DirectoryIndex([package_dir])
 
             # Determine which of the discovered dependencies are on this path.
             for discovered_name in discovered_names:
@@ -137,7 +284,7 @@ def _iter_dependencies(module, visited=None):
                 if not discovered_path:
                     continue
 
-                if discovery.path_is_in_directories(discovered_path, module_import_path):
+                if discovered_path in package_index or discovered_path in sys_path_index:
                     potential_dependencies.append(discovered_name)
 
         # Pull in manually specified dependencies.
@@ -166,6 +313,9 @@ def _iter_dependencies(module, visited=None):
 
         _dependency_lists[module.__name__] = dependencies
 
+        if start is not None:
+            _emit('dependencies', module.__name__, start)
+
         if _VERBOSE > 1:
             print '# DEPENDENCIES FOR', module.__name__
             for x in dependencies:
@@ -176,33 +326,167 @@ def _iter_dependencies(module, visited=None):
 
 
 
-def _iter_chain(module, visited=None):
-    
-    if visited is None:
-        visited = set()
-    
-    # Make sure to not hit the same module twice.
-    if module.__name__ in visited:
-        return
-    visited.add(module.__name__)
-    
-    for dependency in _iter_dependencies(module, visited):
-        for x in _iter_chain(dependency, visited):
-            yield x
-    yield module
+def _build_graph(module):
+    """Collect the dependency graph which is reachable from the given module.
+
+    :returns: ``(modules, edges)``; a dict mapping names to modules, and a dict
+        mapping names to the names of their dependencies.
+
+    """
+
+    modules = {}
+    edges = {}
+
+    stack = [module]
+    while stack:
+
+        module = stack.pop()
+        if module.__name__ in edges:
+            continue
+
+        dependencies = list(_iter_dependencies(module))
+        modules[module.__name__] = module
+        edges[module.__name__] = [x.__name__ for x in dependencies]
+
+        # Reversed so that they are visited in the order they were discovered.
+        stack.extend(reversed(dependencies))
+
+    return modules, edges
+
+
+def _iter_components(root, edges):
+    """Yield the strongly connected components of the graph reachable from root.
+
+    This is Tarjan's algorithm, without the recursion. Components are yielded
+    in topological order; every component comes after all of the components
+    that it depends upon.
+
+    """
+
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+
+    work = [(root, 0)]
+    while work:
+
+        name, i = work.pop()
+        if not i:
+            index[name] = lowlink[name] = len(index)
+            stack.append(name)
+            on_stack.add(name)
 
+        # Visit the children, "recursing" into the first that is new.
+        children = edges[name]
+        while i < len(children):
+            child = children[i]
+            i += 1
+            if child not in index:
+                work.append((name, i))
+                work.append((child, 0))
+                break
+            if child in on_stack:
+                lowlink[name] = min(lowlink[name], index[child])
+        else:
 
+            if lowlink[name] == index[name]:
+                component = []
+                while True:
+                    x = stack.pop()
+                    on_stack.discard(x)
+                    component.append(x)
+                    if x == name:
+                        break
+                yield component
 
+            # "Return" to the parent.
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[name])
 
-def _is_outdated(module):
 
-    file_path = utils.get_source_path(module)
+def _iter_chain(module):
+    """Iterate over a module and all of its dependencies; dependencies first."""
+    modules, edges = _build_graph(module)
+    for component in _iter_components(module.__name__, edges):
+        for name in component:
+            yield modules[name]
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _stat_modules(modules):
+    """Get the modification times of the sources of many modules at once.
+
+    On network filesystems stat-ing is dominated by latency, so we do them
+    in parallel (in ``METATOOLS_RELOAD_STAT_THREADS`` threads).
+
+    :returns: A dict mapping source paths to modification times, or ``None``
+        for those that don't exist.
+
+    """
+
+    global _stat_pool, _stat_pool_pid
+
+    paths = set()
+    for module in modules:
+        path = utils.get_source_path(module, must_exist=False)
+        if path:
+            paths.add(path)
+    paths = list(paths)
+
+    if _STAT_THREADS > 1 and len(paths) > _STAT_THREADS:
+        # Pools can't be shared across a fork.
+        if _stat_pool is None or _stat_pool_pid != os.getpid():
+            _stat_pool = multiprocessing.pool.ThreadPool(_STAT_THREADS)
+            _stat_pool_pid = os.getpid()
+        chunksize = max(1, len(paths) // (_STAT_THREADS * 4))
+        mtimes = _stat_pool.map(_get_mtime, paths, chunksize)
+    else:
+        mtimes = [_get_mtime(path) for path in paths]
+
+    return dict(zip(paths, mtimes))
+
+
+def _is_outdated(module, _mtimes=None):
+
+    global _unwatched_count
+
+    # The watcher knows what changed without touching the filesystem.
+    watcher = _get_watcher()
+    if watcher is not None:
+        file_path = utils.get_source_path(module, must_exist=False)
+        if file_path in watcher:
+            return watcher.pop_dirty(file_path)
+
+    # We may have already been given the modification time.
+    if _mtimes is not None:
+        file_path = utils.get_source_path(module, must_exist=False)
+        modified_time = _mtimes.get(file_path)
+        if modified_time is None:
+            file_path = None
+    else:
+        file_path = utils.get_source_path(module)
+        modified_time = None
 
     if file_path is not None:
-        
+
+        # Watch it before we stat it, so that nothing falls between them.
+        if watcher is not None:
+            watcher.watch(file_path)
+            if file_path not in watcher:
+                _unwatched_count += 1
+
         # Determine if we should reload via mtimes.
         last_modified_time = _modification_times.get(file_path)
-        modified_time = os.path.getmtime(file_path)
+        if modified_time is None:
+            modified_time = os.path.getmtime(file_path)
 
         _modification_times[file_path] = modified_time
         
@@ -214,8 +498,11 @@ def _is_outdated(module):
 
 def is_outdated(module, recursive=True):
     '''Has the source of given module or any of its dependencies changed on disk?'''
-    mods = _iter_chain(module) if recursive else [module]
-    return any(_is_outdated(mod) for mod in mods)
+    if not recursive:
+        return _is_outdated(module)
+    mods = list(_iter_chain(module))
+    mtimes = _stat_modules(mods) if _get_watcher() is None else None
+    return any(_is_outdated(mod, mtimes) for mod in mods)
 
 
 
@@ -236,27 +523,39 @@ def reload(module, _time=None):
 
     '''
 
+    global _reload_count
+
     print '# autoreload: Reloading: %s at 0x%x' % (module.__name__, id(module))
         
     state = None
     if hasattr(module, '__before_reload__'):
+        start = time.time() if _listeners else None
         state = module.__before_reload__()
-        
+        if start is not None:
+            _emit('before_reload', module.__name__, start)
+
+    start = time.time() if _listeners else None
     __builtin__.reload(module)
+    if start is not None:
+        _emit('reload', module.__name__, start)
     
     # Wipe the dependency cache.
     _dependency_lists.pop(module.__name__, None)
 
     # Remember when it was reloaded.
-    _reload_times[module.__name__] = _time or time.time()()
+    _reload_times[module.__name__] = _time or time.time()
+    _reload_count += 1
     if _VERBOSE > 1:
         print '\n'.join('%s: %s' % (t, n) for n, t in sorted(_reload_times.iteritems()))
 
     if hasattr(module, '__after_reload__'):
+        start = time.time() if _listeners else None
         module.__after_reload__(state)
+        if start is not None:
+            _emit('after_reload', module.__name__, start)
 
 
-def autoreload(module, force_self=None, _visited=None, _depth=0, _time=None):
+def autoreload(module, force_self=None, _time=None):
     '''autoreload(module, force_self=None)
 
     Reload the given module if it, or any of its dependencies have new source code.
@@ -267,47 +566,130 @@ def autoreload(module, force_self=None, _visited=None, _depth=0, _time=None):
     
     '''
 
-    if _visited is None:
-        _visited = set()
+    if _time is None:
+        _time = time.time()
 
         # Lets hijack this signal to test ourselves.
         if _DEVELOP:
             m = sys.modules[__name__]
-            if autoreload(m, None, _visited):
+            if autoreload(m, _time=_time):
                 print '# autoreload: Restarting after self-reload.'
-                return m.autoreload(module, force_self, _visited)
-    
-    # Make sure to not hit the same module twice. Don't need to add it to
-    # visited because _iter_dependencies will do that.
-    if module.__name__ in _visited:
-        return
-    _visited.add(module.__name__)
-
-    _time = _time or time.time()
+                return m.autoreload(module, force_self, _time=_time)
 
     if _VERBOSE:
-        if not _depth:
-            print '# autoreload:', module.__name__
-        print '# autoreload: -->' + '  ' * _depth, module.__name__
-
-    my_time = _reload_times.get(module.__name__)
-    if _VERBOSE and my_time:
-        print '# autoreload: %s last reloaded at %s' % (module.__name__, my_time)
-
-    # Give all dependencies a chance to reload.
-    dependency_reloaded = False
-    for dependency in _iter_dependencies(module):
-        dependency_reloaded = autoreload(dependency, _visited=_visited, _depth=_depth+1, _time=_time) or dependency_reloaded
-
-        # Reload if the dependency has been reloaded before us, even if not this time.
-        if not dependency_reloaded:
-            dependency_time = _reload_times.get(dependency.__name__)
-            dependency_reloaded = dependency_time and (not my_time or dependency_time > my_time)
-            if dependency_reloaded and _VERBOSE > 1:
-                print '# autoreload: dependency %s of %s was previously reloaded' % (dependency.__name__, module.__name__)
-    
-    # Reload ourselves if any dependencies did, or if we are out of date.
-    if force_self or dependency_reloaded or _is_outdated(module):
-        reload(module, _time=_time)
-        return True
+        print '# autoreload:', module.__name__
+
+    cycle_start = time.time() if _listeners else None
+
+    start = cycle_start
+    modules, edges = _build_graph(module)
+    if start is not None:
+        _emit('graph', module.__name__, start)
+
+    mtimes = None
+    if _get_watcher() is None:
+        start = time.time() if _listeners else None
+        mtimes = _stat_modules(modules.itervalues())
+        if start is not None:
+            _emit('stat', module.__name__, start)
+
+    # Components come dependencies first, so by the time we get to any one of
+    # them we already know if anything it depends upon was reloaded.
+    reloaded = set()
+    for component in _iter_components(module.__name__, edges):
+
+        # Check every module (instead of stopping at the first) so that all of
+        # their modification times are kept up to date.
+        outdated = []
+        for name in component:
+            start = time.time() if _listeners else None
+            if _is_outdated(modules[name], mtimes):
+                outdated.append(name)
+            if start is not None:
+                _emit('outdated', name, start)
+
+        if outdated and _VERBOSE:
+            print '# autoreload: outdated:', ', '.join(outdated)
+
+        dirty = bool(outdated) or bool(force_self and module.__name__ in component)
+
+        if not dirty:
+            members = set(component)
+            for name in component:
+                my_time = _reload_times.get(name)
+                for dependency in edges[name]:
+                    if dependency in members:
+                        continue
+                    if dependency in reloaded:
+                        dirty = True
+                        break
+                    # Reload if the dependency has been reloaded before us, even if not this time.
+                    dependency_time = _reload_times.get(dependency)
+                    if dependency_time and (not my_time or dependency_time > my_time):
+                        if _VERBOSE > 1:
+                            print '# autoreload: dependency %s of %s was previously reloaded' % (dependency, name)
+                        dirty = True
+                        break
+                if dirty:
+                    break
+
+        if dirty:
+            for name in component:
+                reload(modules[name], _time=_time)
+                reloaded.add(name)
+
+    if cycle_start is not None:
+        _emit('cycle', module.__name__, cycle_start)
+
+    return module.__name__ in reloaded
+
+
+def throttled_autoreload(module, interval=None):
+    '''throttled_autoreload(module, interval=None)
+
+    Like :func:`autoreload`, but skipping it entirely when nothing appears to
+    have changed.
+
+    This is for callers in tight loops (e.g. :func:`.load_entry_point` with
+    ``reload=None``), where walking the dependencies of the module every time
+    would dominate.
+
+    If a watcher is in use (see :func:`use_watcher`), and it could watch every
+    file that the last check looked at, the module is only checked once the
+    watcher has seen a change, or something has been reloaded, since then;
+    this is only as reliable as the watcher (e.g. inotify does not see
+    changes made by other hosts to network filesystems that it doesn't
+    recognise as such, and so doesn't poll). Otherwise, the module
+    is checked at most once every ``interval`` seconds, unless the watcher
+    has seen a change.
+
+    :param module: The module to reload if there are changes.
+    :param float interval: The minimum seconds between checks when the
+        watcher can't be relied upon; ``METATOOLS_RELOAD_INTERVAL`` (or 0)
+        by default.
+    :return: ``True`` if the module was reloaded.
+
+    '''
 
+    if interval is None:
+        interval = _INTERVAL
+
+    now = time.time()
+    watcher = _get_watcher()
+    generation = watcher.generation if watcher is not None else None
+
+    last = _throttled_checks.get(module.__name__)
+    if last is not None:
+        unchanged = watcher is not None and last[1:4] == (watcher, generation, _reload_count)
+        if unchanged and last[4]:
+            return False
+        if (unchanged or watcher is None) and now - last[0] < interval:
+            return False
+
+    # The generation is taken before checking, so changes while we do are
+    # noticed next time. Our own reloads are not a reason to check again.
+    unwatched_count = _unwatched_count
+    reloaded = autoreload(module)
+    covered = watcher is not None and _unwatched_count == unwatched_count
+    _throttled_checks[module.__name__] = (now, watcher, generation, _reload_count, covered)
+    return reloaded
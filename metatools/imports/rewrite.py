@@ -2,18 +2,29 @@ from __future__ import print_function
 
 import sys
 import re
+import collections
 import optparse
 import os
+import multiprocessing
+import shutil
+import tempfile
+import time
 import token
 import itertools
+import codecs
+import threading
+import lib2to3.pgen2.driver
 import lib2to3.pgen2.tokenize
 import lib2to3.pygram
 import lib2to3.pytree
 import hashlib
 import difflib
+import json
 import traceback
 from cStringIO import StringIO
 
+from .. import git
+
 
 def _diff_strings(a, b, filename):
     """Return a unified diff of two strings."""
@@ -27,10 +38,20 @@ def _diff_strings(a, b, filename):
     ))
 
 
-def module_name_for_path(path):
+def module_name_for_path(path, is_package=None):
+    """Get the name of the module at the given path.
+
+    :param is_package: Function to tell if a directory is a package; looks
+        for an ``__init__.py`` on disk by default.
+
+    """
+    is_package = is_package or (lambda dir_: os.path.exists(os.path.join(dir_, '__init__.py')))
     head, module = os.path.split(os.path.splitext(path)[0])
-    while os.path.exists(os.path.join(head, '__init__.py')):
+    # Stop at the top (e.g. the root of a git repository is a package).
+    while head and is_package(head):
         head, tail = os.path.split(head)
+        if not tail:
+            break
         module = tail + '.' + module
 
     # key_base pseudopackages; only the few that the external tools are in,
@@ -61,16 +82,81 @@ def resolve_relative(relative, module):
     return len(orig_relative) - len(relative), '.'.join(x for x in parts if x)
 
 
-def _iter_chunked_source(source):
-    driver = lib2to3.pgen2.driver.Driver(lib2to3.pygram.python_grammar, lib2to3.pytree.convert)
-    
+_print_function_re = re.compile(r'''
+    ^from\s+__future__\s+import\s+
+    (?:\([^)]*|[^\n]*) # Parenthesized names may span lines.
+    \bprint_function\b
+''', re.M | re.X)
+
+
+def has_print_function(source):
+    """Does the given source use ``from __future__ import print_function``?"""
+    return 'print_function' in source and _print_function_re.search(source) is not None
+
+
+def _detect_encoding(source):
+    # Only bother the tokenizer if there may be a BOM or coding cookie.
+    if not source.startswith(codecs.BOM_UTF8) and 'coding' not in '\n'.join(source.split('\n', 2)[:2]):
+        return 'utf-8'
     if hasattr(lib2to3.pgen2.tokenize, 'detect_encoding'):
-        string_io = StringIO(source)
-        encoding, _ = lib2to3.pgen2.tokenize.detect_encoding(string_io.readline)
-    else:
-        encoding = 'utf8'
+        encoding, _ = lib2to3.pgen2.tokenize.detect_encoding(StringIO(source).readline)
+        return encoding
+    return 'utf8'
+
+
+class Parser(object):
+
+    """A thread-safe pool of lib2to3 parsers, for reuse across many sources.
+
+    :func:`rewrite` uses a shared one by default; pass your own to bound how
+    many drivers are kept around. Sources which use
+    ``from __future__ import print_function`` are parsed with the grammar
+    that has no print statement, since they wouldn't parse otherwise.
+
+    :param int size: The most idle drivers to keep for each grammar.
+
+    """
+
+    def __init__(self, size=8):
+        self.size = size
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def parse(self, source, print_function=None):
+        """Parse the given source; returns ``(tree, encoding)``.
+
+        :param bool print_function: Is print a function? Detected from the
+            source if ``None``.
+
+        """
+
+        if print_function is None:
+            print_function = has_print_function(source)
+        if print_function:
+            grammar = lib2to3.pygram.python_grammar_no_print_statement
+        else:
+            grammar = lib2to3.pygram.python_grammar
 
-    tree = driver.parse_string(source)
+        with self._lock:
+            idle = self._idle.get(grammar)
+            driver = idle.pop() if idle else None
+        if driver is None:
+            driver = lib2to3.pgen2.driver.Driver(grammar, lib2to3.pytree.convert)
+
+        try:
+            return driver.parse_string(source), _detect_encoding(source)
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(grammar, [])
+                if len(idle) < self.size:
+                    idle.append(driver)
+
+
+_parser = Parser()
+
+
+def _iter_chunked_source(source, parser=None, print_function=None):
+    tree, encoding = (parser or _parser).parse(source, print_function)
     for is_source, group in itertools.groupby(_iter_chunked_node(tree), lambda (is_source, _): is_source):
         yield is_source, ''.join((value.encode(encoding) if isinstance(value, unicode) else value) for _, value in group)
 
@@ -92,18 +178,72 @@ def _iter_chunked_node(node):
         yield (node.type not in (token.STRING, )), node.value
 
 
-def rewrite(source, mapping, module_name=None, non_source=False, **kw):
+_prefilters = {}
+
+def _get_prefilter(mapping):
+    """Get a regex which finds any top-level name of the modules being renamed."""
+    names = frozenset(old.split('.')[0] for old in mapping)
+    prefilter = _prefilters.get(names)
+    if prefilter is None:
+        prefilter = _prefilters[names] = re.compile(r'\b(?:%s)\b' % '|'.join(
+            re.escape(name) for name in sorted(names, key=len, reverse=True)
+        ))
+    return prefilter
+
+
+def _may_rewrite(source, mapping, module_name, absolute):
+    """Is it at all possible that rewriting will change the source?"""
+
+    # Every "from" import may be changed in these modes.
+    if absolute is not None:
+        return True
+
+    if not mapping:
+        return False
+
+    # Relative imports within a renamed package may not mention it at all.
+    if module_name and module_name.split('.')[0] in set(old.split('.')[0] for old in mapping):
+        return True
+
+    return _get_prefilter(mapping).search(source) is not None
+
+
+def rewrite(source, mapping, module_name=None, non_source=False, parser=None, engine='regex', print_function=None, **kw):
+    """Rewrite the imports and usages of renamed modules in the given source.
+
+    :param dict mapping: Old names to new names.
+    :param str module_name: The name of the module the source is from, for
+        resolving relative imports.
+    :param bool non_source: Treat the source as plain text instead of Python.
+    :param parser: The :class:`Parser` to use; a shared one by default.
+    :param str engine: ``"regex"`` runs regexes over each chunk of the source
+        that isn't a comment or string; ``"tree"`` rewrites the parse tree
+        in a single pass (see :class:`TreeRewriter`).
+    :param bool print_function: Is print a function in this source?
+        Detected if ``None``.
+
+    """
+
+    # Most files don't mention anything being renamed, so don't bother parsing.
+    if not _may_rewrite(source, mapping, module_name, kw.get('absolute')):
+        return source
 
     rewriter = Rewriter(mapping, module_name, **kw)
 
     if non_source:
         return rewriter(source)
 
+    if engine == 'tree':
+        tree, encoding = (parser or _parser).parse(source, print_function)
+        return TreeRewriter(rewriter, encoding)(tree)
+    elif engine != 'regex':
+        raise ValueError('unknown rewrite engine %r' % engine)
+
     rewritten = []
 
     # Break the source into chunks that we may find identifiers in, and those
     # that we won't.
-    for is_source, source in _iter_chunked_source(source):
+    for is_source, source in _iter_chunked_source(source, parser, print_function):
 
         # Don't bother looking in comments and strings.
         if is_source:
@@ -114,6 +254,31 @@ def rewrite(source, mapping, module_name=None, non_source=False, **kw):
     return ''.join(rewritten)
 
 
+_tries = {}
+
+def _compile_mapping(mapping):
+    """Compile a mapping of renames into a trie of their dotted parts.
+
+    Each node is a dict of the next parts, and the new name for the old one
+    that ends at that node (if any) is stored under ``None``.
+
+    """
+
+    key = frozenset(mapping.iteritems())
+    trie = _tries.get(key)
+
+    if trie is None:
+        trie = {}
+        for old, new in mapping.iteritems():
+            node = trie
+            for part in old.split('.'):
+                node = node.setdefault(part, {})
+            node[None] = new
+        _tries[key] = trie
+
+    return trie
+
+
 class Rewriter(object):
 
     _direct_import_re = re.compile(r'''
@@ -154,6 +319,9 @@ class Rewriter(object):
         self.absolute = absolute
         self.substitutions = {}
 
+        self._trie = _compile_mapping(mapping)
+        self._converted = {}
+
     def __call__(self, source):
 
         source = self._import_from_re.sub(self.import_from, source)
@@ -180,12 +348,31 @@ class Rewriter(object):
     def import_from(self, m):
 
         # print 'import_from:', m.groups()
-        was_relative, base = resolve_relative(m.group(1), self.module_name)
+        new_base, imports = self.convert_import_from(m.group(1), self.split_as_block(m.group(2)))
+        imports = [('%s as %s' % (name, ident) if ident else name) for name, ident in imports]
+
+        # Format the final source.
+        return self.add_substitution('from %s import %s' % (
+            new_base,
+            ', '.join(imports)
+        ))
+
+    def convert_import_from(self, base, names):
+        """Convert a ``from base import names`` statement.
+
+        :param str base: The (possibly relative) module being imported from.
+        :param names: Iterable of ``(name, ident)`` pairs, where ``ident`` is
+            the name it is imported "as" (or ``None``).
+        :returns: ``(new_base, [(new_name, ident), ...])``
+
+        """
+
+        was_relative, base = resolve_relative(base, self.module_name)
 
         imports = []
 
         # Convert the full names of every item.
-        for name, ident in self.split_as_block(m.group(2)):
+        for name, ident in names:
             full_name = base + '.' + name
             imports.append((
                 self.convert_module(full_name) or full_name,
@@ -203,15 +390,7 @@ class Rewriter(object):
         else:
             new_base = '.'.join(new_base)
 
-        # Rebuild the "as" block.
-        imports = [(name.split('.')[-1], ident) for name, ident in imports]
-        imports = [('%s as %s' % (name, ident) if ident else name) for name, ident in imports]
-
-        # Format the final source.
-        return self.add_substitution('from %s import %s' % (
-            new_base,
-            ', '.join(imports)
-        ))
+        return new_base, [(name.split('.')[-1], ident) for name, ident in imports]
 
     def make_relative(self, target):
         base = (self.convert_module(self.module_name) or self.module_name).split('.')
@@ -245,89 +424,904 @@ class Rewriter(object):
         return name
 
     def convert_module(self, name):
-        parts = name.split('.')
-        for old, new in self.mapping.iteritems():
-            old_parts = old.split('.')
-            if parts[:len(old_parts)] == old_parts:
-                return '.'.join([new] + parts[len(old_parts):])
+        """Get the new name of a module, or ``None`` if it was not renamed.
+
+        If more than one rename applies, the one for the longest prefix wins.
+
+        """
+
+        try:
+            return self._converted[name]
+        except KeyError:
+            pass
+
+        converted = None
+        node = self._trie
+
+        # Most names won't match at all.
+        if name.split('.', 1)[0] in node:
+
+            parts = name.split('.')
+            for i, part in enumerate(parts):
+                node = node.get(part)
+                if node is None:
+                    break
+                if None in node:
+                    converted = '.'.join([node[None]] + parts[i + 1:])
+
+        self._converted[name] = converted
+        return converted
 
     def convert_identifier(self, name):
-        parts = name.split('.')
-        for old, new in self.mapping.iteritems():
-            old_parts = old.split('.')
-            if parts[:len(old_parts)] == old_parts:
-                return '.'.join([new] + parts[len(old_parts):])
+        return self.convert_module(name)
+
+
+
+_syms = lib2to3.pygram.python_symbols
+
+
+def _is_attribute(node):
+    return node.type == _syms.trailer and node.children[0].value == '.'
+
+
+class TreeRewriter(object):
 
+    """Rewrites a parse tree in a single pass over its nodes.
 
+    Instead of running regexes over the source (and patching the imports back
+    in afterwards), this walks the tree once, converts import statements and
+    dotted names as it finds them, and joins the output at the end. Since it
+    works on the tree, it also handles parenthesized imports, preserves the
+    formatting of statements that aren't changed, and doesn't touch
+    attributes of anything other than a name (e.g. ``foo().bar``).
+
+    :param rewriter: The :class:`Rewriter` to convert names with.
+    :param str encoding: What to encode unicode leaves as.
+
+    """
+
+    def __init__(self, rewriter, encoding='utf8'):
+        self.rewriter = rewriter
+        self.encoding = encoding
+        self._output = []
+
+    def __call__(self, tree):
+        self._output = []
+        self.visit(tree)
+        output = ''.join(self._output)
+        self._output = []
+        return output
+
+    def emit(self, value):
+        self._output.append(value.encode(self.encoding) if isinstance(value, unicode) else value)
+
+    def emit_verbatim(self, node):
+        for leaf in node.leaves():
+            self.emit(leaf.prefix)
+            self.emit(leaf.value)
+
+    def visit(self, node):
+
+        type_ = node.type
+
+        if type_ == token.NAME:
+            self.emit(node.prefix)
+            self.emit(self.rewriter.convert_identifier(node.value) or node.value)
+        elif type_ < 256:
+            # Every other leaf; comments and whitespace are in the prefix.
+            self.emit(node.prefix)
+            self.emit(node.value)
+        elif type_ == _syms.import_name:
+            self.visit_import_name(node)
+        elif type_ == _syms.import_from:
+            self.visit_import_from(node)
+        elif type_ == _syms.power and node.children[0].type == token.NAME:
+            self.visit_power(node)
+        elif type_ == _syms.dotted_name:
+            # e.g. decorators.
+            self.visit_dotted_name(node, self.rewriter.convert_identifier)
+        elif _is_attribute(node):
+            self.emit_verbatim(node)
+        else:
+            for child in node.children:
+                self.visit(child)
+
+    def visit_dotted_name(self, node, convert):
+        name = ''.join(leaf.value for leaf in node.leaves())
+        new_name = convert(name)
+        if new_name is None:
+            self.emit_verbatim(node)
+        else:
+            self.emit(node.prefix)
+            self.emit(new_name)
+
+    def visit_power(self, node):
+
+        # The longest run of "name.attr.attr" at the start.
+        children = node.children
+        end = 1
+        while end < len(children) and _is_attribute(children[end]):
+            end += 1
+
+        name = '.'.join([children[0].value] + [x.children[1].value for x in children[1:end]])
+        new_name = self.rewriter.convert_identifier(name)
+        if new_name is None:
+            for child in children[:end]:
+                self.emit_verbatim(child)
+        else:
+            self.emit(node.prefix)
+            self.emit(new_name)
+
+        for child in children[end:]:
+            self.visit(child)
+
+    def visit_import_name(self, node):
+        keyword, names = node.children
+        self.emit_verbatim(keyword)
+        self.visit_dotted_as_names(names)
+
+    def visit_dotted_as_names(self, node):
+        if node.type == _syms.dotted_as_names:
+            for child in node.children:
+                if child.type == token.COMMA:
+                    self.emit_verbatim(child)
+                else:
+                    self.visit_dotted_as_names(child)
+        elif node.type == _syms.dotted_as_name:
+            # The "as" identifier is left alone.
+            self.visit_dotted_as_names(node.children[0])
+            for child in node.children[1:]:
+                self.emit_verbatim(child)
+        else:
+            self.visit_dotted_name(node, self.rewriter.convert_module)
+
+    def _iter_import_as_names(self, node):
+        if node.type == _syms.import_as_names:
+            for child in node.children:
+                if child.type != token.COMMA:
+                    for x in self._iter_import_as_names(child):
+                        yield x
+        elif node.type == _syms.import_as_name:
+            yield node.children[0], node.children[2].value
+        elif node.type in (token.NAME, token.STAR):
+            yield node, None
+
+    def visit_import_from(self, node):
+
+        children = node.children
+        for i, child in enumerate(children):
+            if child.type == token.NAME and child.value == 'import':
+                break
+        base_nodes = children[1:i]
+        base = ''.join(leaf.value for x in base_nodes for leaf in x.leaves())
+
+        name_leaves = []
+        for x in children[i + 1:]:
+            name_leaves.extend(self._iter_import_as_names(x))
+
+        new_base, new_names = self.rewriter.convert_import_from(
+            base,
+            [(leaf.value, ident) for leaf, ident in name_leaves],
+        )
+        new_values = dict((id(leaf), name) for (leaf, _), (name, _) in zip(name_leaves, new_names))
+
+        self.emit_verbatim(children[0])
+        if new_base == base:
+            for x in base_nodes:
+                self.emit_verbatim(x)
+        else:
+            self.emit(base_nodes[0].prefix)
+            self.emit(new_base)
+        self.emit_verbatim(children[i])
+
+        for x in children[i + 1:]:
+            for leaf in x.leaves():
+                self.emit(leaf.prefix)
+                self.emit(new_values.get(id(leaf), leaf.value))
+
+
+def iter_paths(args):
+    """Iterate over the Python files given, or within the directories given.
+
+    Paths are yielded once each, in a stable (sorted) order.
+
+    """
+
+    visited_paths = set()
+
+    for arg in args:
+
+        if os.path.isdir(arg):
+            paths = []
+            for dir_name, dir_names, file_names in os.walk(arg):
+                dir_names[:] = sorted(x for x in dir_names if not x.startswith('.'))
+                paths.extend(os.path.join(dir_name, x) for x in sorted(file_names))
+        else:
+            paths = [arg]
+
+        for path in paths:
+            name = os.path.basename(path)
+            if name.startswith('._') or not name.endswith('.py'):
+                continue
+            if path in visited_paths:
+                continue
+            visited_paths.add(path)
+            yield path
+
+
+def write_atomic(path, content):
+    """Replace the contents of the given file, such that it is never partially written."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(content)
+        shutil.copymode(path, tmp_path)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def make_edits(original, refactored):
+    """Get the line edits which turn one source into another.
+
+    :returns: A list of ``(start, end, text)``, meaning that lines
+        ``start:end`` of the original are replaced with ``text``.
+
+    """
+    a = original.splitlines(True)
+    b = refactored.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, a, b)
+    return [
+        (i1, i2, ''.join(b[j1:j2]))
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != 'equal'
+    ]
+
+
+def apply_edits(original, edits):
+    """Apply the edits from :func:`make_edits`."""
+    lines = original.splitlines(True)
+    for start, end, text in sorted(edits, reverse=True):
+        lines[start:end] = text.splitlines(True)
+    return ''.join(lines)
+
+
+def _normalize(source):
+    return source.rstrip() + '\n'
+
+
+def save_plan(path, mapping, files):
+    """Write a manifest of planned rewrites; this is atomic.
+
+    :param dict mapping: The renames which were planned.
+    :param dict files: Maps paths to ``(sha1, edits)``, where ``sha1`` is the
+        hex digest of the file's current contents.
+
+    """
+    data = {
+        'version': 1,
+        'mapping': mapping,
+        'files': dict((p, {'sha1': sha1, 'edits': edits}) for p, (sha1, edits) in files.iteritems()),
+    }
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as fh:
+        # Latin-1 round-trips any bytes, whatever the source encoding.
+        json.dump(data, fh, encoding='latin-1', separators=(',', ':'), sort_keys=True)
+        fh.write('\n')
+    os.rename(tmp_path, path)
+
+
+def load_plan(path):
+    """Read a manifest written by :func:`save_plan`.
+
+    :returns: ``(mapping, files)``, as given to :func:`save_plan`.
+
+    """
+
+    with open(path) as fh:
+        data = json.load(fh)
+    if data.get('version') != 1:
+        raise ValueError('unsupported plan version %r' % data.get('version'))
+
+    def encode(x):
+        return x.encode('latin-1')
+
+    mapping = dict((encode(k), encode(v)) for k, v in data['mapping'].iteritems())
+    files = {}
+    for p, entry in data['files'].iteritems():
+        files[encode(p)] = (
+            encode(entry['sha1']),
+            [(start, end, encode(text)) for start, end, text in entry['edits']],
+        )
+    return mapping, files
+
+
+def apply_plan(files, write=True):
+    """Apply planned rewrites, without parsing anything.
+
+    Files which have changed since they were planned are refused.
+
+    :param dict files: As returned by :func:`load_plan`.
+    :returns: ``(applied, refused)`` lists of paths.
+
+    """
+
+    applied = []
+    refused = []
+
+    for path, (sha1, edits) in sorted(files.iteritems()):
+
+        try:
+            content = open(path).read()
+        except IOError:
+            refused.append(path)
+            continue
+        if hashlib.sha1(content).hexdigest() != sha1:
+            refused.append(path)
+            continue
+
+        if write:
+            write_atomic(path, apply_edits(_normalize(content), edits))
+        applied.append(path)
+
+    return applied, refused
+
+
+_continuations = frozenset(('else', 'elif', 'except', 'finally'))
+
+
+def iter_statements(readline):
+    """Split source into its top-level statements, reading it only as needed.
+
+    Decorators are kept with what they decorate, the clauses of a compound
+    statement (e.g. ``else``) are kept together, and comments and blank lines
+    go with the statement after them; every line is in exactly one chunk.
+
+    :param readline: Returns the next line of the source, or ``''`` at the end.
+    :returns: An iterator of strings.
+
+    """
+
+    tokenize = lib2to3.pgen2.tokenize
+
+    lines = []
+    first_row = 1
+    end_row = None # The last row of the previous statement.
+    level = 0
+    at_start = True
+    decorator = False
+
+    def _readline():
+        line = readline()
+        lines.append(line)
+        return line
+
+    for type_, value, (row, _), _, _ in tokenize.generate_tokens(_readline):
+
+        if type_ == tokenize.INDENT:
+            level += 1
+        elif type_ == tokenize.DEDENT:
+            level -= 1
+        elif type_ == tokenize.NEWLINE:
+            end_row = row
+            at_start = True
+        elif type_ in (tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER):
+            pass
+        elif at_start:
+            at_start = False
+            if level:
+                continue
+            if end_row is not None and not decorator and value not in _continuations:
+                count = end_row - first_row + 1
+                yield ''.join(lines[:count])
+                del lines[:count]
+                first_row = end_row + 1
+            end_row = None
+            decorator = value == '@'
+
+    if lines:
+        yield ''.join(lines)
+
+
+def _format_range(start, stop):
+    # The same as difflib's unified diffs.
+    length = stop - start
+    if length == 1:
+        return '%d' % (start + 1)
+    return '%d,%d' % (start + 1 if length else start, length)
+
+
+def iter_diff(pairs, filename, n=3):
+    """Generate the same unified diff as :func:`_diff_strings`, but from chunks.
+
+    Only the surrounding context is kept in memory, not either whole source.
+
+    :param pairs: Iterable of ``(original, refactored)`` chunks, which must
+        both end with a newline (if they aren't empty).
+    :returns: An iterator of the lines of the diff, without line endings.
+
+    """
+
+    context = collections.deque(maxlen=n)
+    hunk = None # [a_start, a_len, b_start, b_len, lines]
+    trailing = [] # Unchanged lines after the last change in the hunk.
+    removed = [] # The current run of changes, since difflib groups
+    added = []   # consecutive changes as all removals then all additions.
+    a_pos = b_pos = 0
+    started = False
+
+    for original, refactored in pairs:
+
+        a = original.splitlines()
+        if original == refactored:
+            ops = [('equal', 0, len(a), 0, len(a))]
+            b = a
+        else:
+            b = refactored.splitlines()
+            ops = difflib.SequenceMatcher(None, a, b).get_opcodes()
+
+        for tag, i1, i2, j1, j2 in ops:
+
+            if tag == 'equal':
+                if removed or added:
+                    hunk[4].extend(removed)
+                    hunk[4].extend(added)
+                    removed = []
+                    added = []
+                for i in xrange(i1, i2):
+                    if hunk is None:
+                        # Nothing to buffer beyond the leading context.
+                        context.extend(a[i:i2])
+                        break
+                    trailing.append(a[i])
+                    if len(trailing) > 2 * n:
+                        for line in _finish_hunk(hunk, trailing[:n], started, filename):
+                            yield line
+                        started = True
+                        context.extend(trailing[-n:])
+                        hunk = None
+                        trailing = []
+                a_pos += i2 - i1
+                b_pos += j2 - j1
+                continue
+
+            if hunk is None:
+                hunk = [a_pos - len(context), len(context), b_pos - len(context), len(context), [' ' + x for x in context]]
+                context.clear()
+            else:
+                hunk[1] += len(trailing)
+                hunk[3] += len(trailing)
+                hunk[4].extend(' ' + x for x in trailing)
+                trailing = []
+
+            hunk[1] += i2 - i1
+            hunk[3] += j2 - j1
+            removed.extend('-' + x for x in a[i1:i2])
+            added.extend('+' + x for x in b[j1:j2])
+            a_pos += i2 - i1
+            b_pos += j2 - j1
+
+    if hunk is not None:
+        hunk[4].extend(removed)
+        hunk[4].extend(added)
+        for line in _finish_hunk(hunk, trailing[:n], started, filename):
+            yield line
+
+
+def _finish_hunk(hunk, trailing, started, filename):
+    a_start, a_len, b_start, b_len, lines = hunk
+    if not started:
+        yield '--- %s\t(original)' % filename
+        yield '+++ %s\t(refactored)' % filename
+    yield '@@ -%s +%s @@' % (
+        _format_range(a_start, a_start + a_len + len(trailing)),
+        _format_range(b_start, b_start + b_len + len(trailing)),
+    )
+    for line in lines:
+        yield line
+    for line in trailing:
+        yield ' ' + line
+
+
+def iter_rewrite(chunks, mapping, module_name=None, **kw):
+    """Rewrite source one chunk at a time, e.g. from :func:`iter_statements`.
+
+    :param kw: Passed to :func:`rewrite`.
+    :returns: An iterator of ``(original, refactored)`` pairs.
+
+    """
+    print_function = False
+    for chunk in chunks:
+        # Future imports come first, and apply to every chunk after them.
+        print_function = print_function or has_print_function(chunk)
+        yield chunk, rewrite(chunk, mapping, module_name, print_function=print_function, **kw)
+
+
+def _normalize_last(chunks):
+    previous = None
+    for chunk in chunks:
+        if previous is not None:
+            yield previous
+        previous = chunk
+    if previous is not None:
+        yield _normalize(previous)
+
+
+# Bump this whenever the output of rewrite() changes, to invalidate caches.
+REWRITER_VERSION = 1
+
+
+class RewriteCache(object):
+
+    """A directory of rewritten sources, so repeated runs skip unchanged files.
+
+    Entries are keyed by a hash of the source, the mapping, the module name,
+    the options given to :func:`rewrite`, and :data:`REWRITER_VERSION`, so
+    they never need to be invalidated; just delete the directory to clear it.
+    Many processes may share one cache.
+
+    :param str path: The directory to store entries in; created if needed.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, source, mapping, module_name=None, kwargs=None):
+        hash_ = hashlib.sha1(json.dumps([
+            REWRITER_VERSION,
+            sorted(mapping.iteritems()),
+            module_name,
+            sorted((kwargs or {}).iteritems()),
+        ]))
+        hash_.update('\0')
+        hash_.update(source)
+        return hash_.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key, source):
+        """Get the rewritten source, or ``None`` if not cached."""
+        try:
+            with open(self._path(key), 'rb') as fh:
+                data = fh.read()
+        except IOError:
+            return
+        # "=" means unchanged, so we don't store a copy of every file.
+        if data == '=':
+            return source
+        if data[:1] == '+':
+            return data[1:]
+
+    def set(self, key, source, refactored):
+        path = self._path(key)
+        dir_ = os.path.dirname(path)
+        if not os.path.exists(dir_):
+            try:
+                os.makedirs(dir_)
+            except OSError:
+                # Another process may have just made it.
+                if not os.path.exists(dir_):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=dir_, prefix='.')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write('=' if refactored == source else '+' + refactored)
+        os.rename(tmp_path, path)
+
+
+# The arguments for process_path, set by _init_worker.
+_worker = {}
+
+def _init_worker(mapping, kwargs, cache_path=None, stream=False, write=False):
+    _worker['mapping'] = mapping
+    _worker['kwargs'] = kwargs
+    _worker['cache'] = RewriteCache(cache_path) if cache_path else None
+    _worker['stream'] = stream
+    _worker['write'] = write
+
+
+def process_path(path, content=None, module_name=None):
+    """Rewrite the given file, as configured by ``_init_worker``.
+
+    :param str content: The file's contents, if already read (e.g. from git).
+    :param str module_name: The module's name, if already known.
+
+    :returns: ``(path, lines, diff, refactored, error, plan)``; ``diff``,
+        ``refactored``, and ``plan`` are ``None`` if nothing changed, and
+        ``error`` is a formatted traceback if anything went wrong. ``plan``
+        is the ``(sha1, edits)`` for :func:`save_plan`.
+
+    When streaming, see :func:`stream_path` instead; the cache isn't used.
+
+    """
+
+    if content is None and _worker['stream']:
+        return stream_path(path)
+
+    try:
+
+        if module_name is None:
+            module_name = module_name_for_path(path)
+        if content is None:
+            content = open(path).read()
+        original = _normalize(content)
+
+        cache = _worker['cache']
+        if cache is not None:
+            key = cache.key(original, _worker['mapping'], module_name, _worker['kwargs'])
+            refactored = cache.get(key, original)
+        else:
+            refactored = None
+
+        if refactored is None:
+            refactored = rewrite(original, _worker['mapping'], module_name, **_worker['kwargs'])
+            if cache is not None:
+                cache.set(key, original, refactored)
+
+        lines = original.count('\n')
+
+        if re.sub(r'\s+', '', refactored) != re.sub(r'\s+', '', original):
+            plan = (hashlib.sha1(content).hexdigest(), make_edits(original, refactored))
+            return path, lines, _diff_strings(original, refactored, path), refactored, None, plan
+        return path, lines, None, None, None, None
+
+    except Exception:
+        return path, 0, None, None, traceback.format_exc(), None
+
+
+def _process_blob(args):
+    return process_path(*args)
+
+
+def iter_git_sources(spec, prefixes=(), reader=None):
+    """Iterate over the Python files changed in a git revision range.
+
+    Nothing is read from the working copy; the files (and which directories
+    are packages) come straight from the repository at the end of the range.
+
+    :param str spec: The range, e.g. ``"A..B"``; see :func:`metatools.git.parse_range`.
+    :param list prefixes: Only include paths within these directories.
+    :param reader: The :class:`~metatools.git.BlobReader` to use.
+    :returns: An iterator of ``(path, content, module_name)``, with paths
+        relative to the root of the repository.
+
+    """
+
+    old, new = git.parse_range(spec)
+
+    prefixes = [x.rstrip('/') + '/' for x in prefixes]
+    paths = [
+        x for x in git.changed_paths(old, new)
+        if x.endswith('.py') and not os.path.basename(x).startswith('._')
+        and (not prefixes or any(x.startswith(p) for p in prefixes))
+    ]
+    if not paths:
+        return
+
+    packages = set(
+        os.path.dirname(x) for x in git.list_paths(new)
+        if os.path.basename(x) == '__init__.py'
+    )
+
+    reader = reader or git.BlobReader()
+    for path, (_, content) in itertools.izip(paths, reader.read_many(new + ':' + x for x in paths)):
+        if content is not None:
+            yield path, content, module_name_for_path(path, packages.__contains__)
+
+
+def stream_path(path):
+    """Rewrite the given file one statement at a time, as configured by ``_init_worker``.
+
+    Memory use is proportional to the largest top-level statement in the file
+    rather than to the whole file, since neither the source, the rewritten
+    source, nor the diff is ever held in memory at once.
+
+    :returns: The same as :func:`process_path`, except that ``diff`` is the
+        path to a temporary file containing the diff (which the caller must
+        remove), and ``refactored`` is always ``None``; the file has already
+        been replaced if the worker was configured to ``write``.
+
+    """
+
+    diff_path = out_path = None
+    handles = []
+    try:
+
+        module_name = module_name_for_path(path)
+        digest = hashlib.sha1()
+        edits = []
+        lines = [0]
+
+        # If anything other than whitespace changed; as for process_path,
+        # whitespace changes are only kept alongside others.
+        significant = [False]
+
+        fd, diff_path = tempfile.mkstemp(prefix='metatools.rewrite.', suffix='.diff')
+        diff_fh = os.fdopen(fd, 'w')
+        handles.append(diff_fh)
+        if _worker['write']:
+            fd, out_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path) + '.')
+            out_fh = os.fdopen(fd, 'wb')
+            handles.append(out_fh)
+
+        def readline():
+            line = fh.readline()
+            digest.update(line)
+            return line
+
+        def record(pairs):
+            for original, refactored in pairs:
+                if out_path:
+                    out_fh.write(refactored)
+                if original != refactored:
+                    if not significant[0] and re.sub(r'\s+', '', refactored) != re.sub(r'\s+', '', original):
+                        significant[0] = True
+                    for start, end, text in make_edits(original, refactored):
+                        start += lines[0]
+                        end += lines[0]
+                        # Merge with the previous statement's, as for a whole file.
+                        if edits and edits[-1][1] == start:
+                            start, _, prev_text = edits.pop()
+                            text = prev_text + text
+                        edits.append((start, end, text))
+                lines[0] += original.count('\n')
+                yield original, refactored
+
+        with open(path) as fh:
+            chunks = _normalize_last(iter_statements(readline))
+            pairs = iter_rewrite(chunks, _worker['mapping'], module_name, **_worker['kwargs'])
+            for line in iter_diff(record(pairs), path):
+                diff_fh.write(line + '\n')
+            for x in handles:
+                x.close()
+
+        if not significant[0]:
+            return path, lines[0], None, None, None, None
+
+        if out_path:
+            shutil.copymode(path, out_path)
+            os.rename(out_path, path)
+            out_path = None
+        result = path, lines[0], diff_path, None, None, (digest.hexdigest(), edits)
+        diff_path = None # The caller cleans it up.
+        return result
+
+    except Exception:
+        return path, 0, None, None, traceback.format_exc(), None
+
+    finally:
+        for x in handles:
+            x.close()
+        for x in (diff_path, out_path):
+            if x:
+                os.unlink(x)
 
 
 def main():
 
-    opt_parser = optparse.OptionParser(usage="%prog [options] from:to... path...")
+    opt_parser = optparse.OptionParser(usage="%prog [options] from:to... path...\n       %prog --apply PLAN")
     opt_parser.add_option('-w', '--write', action='store_true')
     opt_parser.add_option('-a', '--absolute', action='store_true')
+    opt_parser.add_option('-j', '--jobs', type='int', help='number of processes to rewrite files in')
+    opt_parser.add_option('-e', '--engine', choices=('regex', 'tree'), default='regex',
+        help='how to rewrite each file; "regex" (the default) or "tree"')
+    opt_parser.add_option('-s', '--stream', action='store_true',
+        help='rewrite statement by statement, to bound memory on huge files')
+    opt_parser.add_option('-c', '--cache', metavar='DIR',
+        help='cache results here, so unchanged files are skipped next time; '
+             'METATOOLS_REWRITE_CACHE by default, except when streaming')
+    opt_parser.add_option('--plan', metavar='PLAN', help='write the planned edits to this manifest')
+    opt_parser.add_option('-g', '--git', metavar='RANGE',
+        help='only rewrite Python files changed in this git range (e.g. A..B), read from the repository; '
+             'paths are then optional directories (from the root of the repository) to limit it to')
+    opt_parser.add_option('--apply', metavar='PLAN', help='apply the edits from this manifest, without parsing')
     opts, args = opt_parser.parse_args()
 
+    if opts.apply:
+        mapping, files = load_plan(opts.apply)
+        start_time = time.time()
+        applied, refused = apply_plan(files)
+        print('Applied (%d) in %.2fs' % (len(applied), time.time() - start_time), file=sys.stderr)
+        print('\n'.join(applied), file=sys.stderr)
+        if refused:
+            print('Refused; changed since planned (%d)' % len(refused), file=sys.stderr)
+            print('\n'.join(refused), file=sys.stderr)
+            exit(1)
+        return
+
     renames = []
     for i, arg in enumerate(args):
         if ':' not in arg:
             break
         old, new = arg.split(':', 1)
         renames.append((old, new))
-    args = args[i:]
+    args = args[len(renames):]
 
-    if not renames or not args:
+    if not renames or not (args or opts.git):
         opt_parser.print_usage()
         exit(1)
+    if opts.git and (opts.write or opts.stream):
+        opt_parser.error('--git only shows the diff; it cannot --write or --stream')
+    if opts.stream and opts.cache:
+        opt_parser.error('--stream cannot use a --cache')
+    if not opts.stream:
+        opts.cache = opts.cache or os.environ.get('METATOOLS_REWRITE_CACHE')
+
+    init_args = (dict(renames), dict(absolute=opts.absolute, engine=opts.engine), opts.cache, opts.stream, opts.write)
+    if opts.git:
+        reader = git.BlobReader()
+        func = _process_blob
+        items = iter_git_sources(opts.git, args, reader)
+    else:
+        reader = None
+        func = process_path
+        items = iter_paths(args)
 
-    visited_paths = set()
-    changed = set()
-
-    def process(dir_name, path):
-
-        if path.startswith('._') or not path.endswith('.py'):
-            return
-
-        if dir_name is not None:
-            path = os.path.join(dir_name, path)
-
-        if path in visited_paths:
-            return
-        visited_paths.add(path)
-
-        print('#', path, file=sys.stderr)
-
-        module_name = module_name_for_path(path)
-        original = open(path).read().rstrip() + '\n'
-        refactored = rewrite(original, dict(renames), module_name, absolute=opts.absolute)
-
-        if re.sub(r'\s+', '', refactored) != re.sub(r'\s+', '', original):
-            print(_diff_strings(original, refactored, path))
-            if opts.write:
-                with open(path, 'wb') as fh:
-                    fh.write(refactored)
-
-    for arg in args:
+    if opts.jobs and opts.jobs > 1:
+        pool = multiprocessing.Pool(opts.jobs, _init_worker, init_args)
+        results = pool.imap(func, items, chunksize=16)
+    else:
+        pool = None
+        _init_worker(*init_args)
+        results = itertools.imap(func, items)
 
-        try:
-            process(None, arg)
-        except Exception:
-            print('# ERROR during', arg, file=sys.stderr)
-            traceback.print_exc()
-
-        for dir_name, dir_names, file_names in os.walk(arg):
-            dir_names[:] = [x for x in dir_names if not x.startswith('.')]
-            for file_name in file_names:
-                try:
-                    process(dir_name, file_name)
-                except Exception:
-                    print('# ERROR during', os.path.join(dir_name, file_name), file=sys.stderr)
-                    traceback.print_exc()
+    start_time = time.time()
+    count = 0
+    total_lines = 0
+    changed = set()
+    failed = set()
+    planned = {}
+
+    try:
+        for path, lines, diff, refactored, error, plan in results:
+
+            count += 1
+            total_lines += lines
+            print('#', path, file=sys.stderr)
+
+            if error:
+                print('# ERROR during', path, file=sys.stderr)
+                print(error, file=sys.stderr, end='')
+                failed.add(path)
+                continue
+
+            if diff is not None:
+                changed.add(path)
+                planned[path] = plan
+                if opts.stream:
+                    # The worker has already written it.
+                    with open(diff) as fh:
+                        shutil.copyfileobj(fh, sys.stdout)
+                    os.unlink(diff)
+                else:
+                    print(diff)
+                    if opts.write:
+                        write_atomic(path, refactored)
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if reader is not None:
+            reader.close()
+
+    elapsed = time.time() - start_time
+
+    if opts.plan:
+        save_plan(opts.plan, init_args[0], planned)
 
     print('Modified (%d)' % len(changed), file=sys.stderr)
     print('\n'.join(sorted(changed)), file=sys.stderr)
+    if failed:
+        print('Failed (%d)' % len(failed), file=sys.stderr)
+        print('\n'.join(sorted(failed)), file=sys.stderr)
+    print('Processed %d files (%d lines) in %.2fs; %.1f files/s, %.0f lines/s' % (
+        count, total_lines, elapsed,
+        count / elapsed if elapsed else 0,
+        total_lines / elapsed if elapsed else 0,
+    ), file=sys.stderr)
 
 
 if __name__ == '__main__':
     main()
-
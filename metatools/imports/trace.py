@@ -0,0 +1,92 @@
+"""Recording timings of reloads for later inspection.
+
+:class:`ChromeTrace` is a listener for :func:`metatools.imports.reload.add_listener`
+which records everything in Chrome's trace event format, which may be viewed
+via ``chrome://tracing`` or https://ui.perfetto.dev::
+
+    >>> from metatools.imports.reload import add_listener
+    >>> from metatools.imports.trace import ChromeTrace
+    >>> add_listener(ChromeTrace('/tmp/reload.json'))
+
+"""
+
+import atexit
+import collections
+import json
+import os
+import thread
+
+
+# Events which mean that something was actually reloaded.
+_RELOAD_EVENTS = frozenset(('before_reload', 'reload', 'after_reload'))
+
+
+class ChromeTrace(object):
+
+    """A reload listener which records Chrome trace events.
+
+    So that it may be left running in long sessions, only the most recent
+    ``max_events`` are kept, and (unless ``idle_cycles``) the events of
+    :func:`~metatools.imports.reload.autoreload` cycles which reloaded nothing
+    are dropped.
+
+    :param str path: Where to save the trace when the process exits;
+        otherwise call :meth:`save` yourself.
+    :param int max_events: How many events to keep; ``None`` for all.
+    :param bool idle_cycles: Keep the events of cycles which reloaded nothing.
+
+    """
+
+    def __init__(self, path=None, max_events=100000, idle_cycles=False):
+        self.path = path
+        self.idle_cycles = idle_cycles
+        self.events = collections.deque(maxlen=max_events)
+        # The events of the cycle in progress, and if it has reloaded anything.
+        self._pending = []
+        self._reloaded = False
+        if path:
+            atexit.register(self.save)
+
+    def __call__(self, event, name, start, duration):
+        self._pending.append({
+            'name': '%s %s' % (event, name),
+            'cat': event,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int(duration * 1e6),
+            'pid': os.getpid(),
+            'tid': thread.get_ident(),
+            'args': {'module': name},
+        })
+        if event in _RELOAD_EVENTS:
+            self._reloaded = True
+        elif event == 'cycle':
+            self._flush(self._reloaded or self.idle_cycles)
+
+    def _flush(self, keep=True):
+        if keep:
+            self.events.extend(self._pending)
+        self._pending = []
+        self._reloaded = False
+
+    def save(self, path=None):
+        """Write the trace to disk; this is atomic."""
+        path = path or self.path
+        self._flush(self._reloaded or self.idle_cycles)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump({'traceEvents': list(self.events)}, fh)
+        os.rename(tmp_path, path)
+
+    def summarize(self, event='reload'):
+        """Get the total time spent per module on the given event.
+
+        :returns: A list of ``(seconds, name)``, slowest first.
+
+        """
+        totals = {}
+        for x in self.events:
+            if x['cat'] == event:
+                name = x['args']['module']
+                totals[name] = totals.get(name, 0) + x['dur'] / 1e6
+        return sorted(((t, n) for n, t in totals.iteritems()), reverse=True)
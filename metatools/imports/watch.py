@@ -0,0 +1,347 @@
+"""Watching source files for changes in the background.
+
+A watcher keeps a set of the source files that have changed since they were
+last checked, so that :func:`~metatools.imports.reload.autoreload` can find
+out what is outdated without touching the filesystem. See
+:func:`metatools.imports.reload.use_watcher`.
+
+There are two backends:
+
+- ``"inotify"`` uses the Linux inotify API (via :mod:`ctypes`) to be told
+  about changes as they happen. Since inotify is not told about changes made
+  by other hosts on network filesystems (e.g. NFS), files on those are
+  polled instead.
+- ``"poll"`` stats every watched file from a background thread.
+
+``"auto"`` will use inotify if it is available, and polling otherwise.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+
+class Watcher(object):
+
+    """Base class of watchers; tracks the watched and dirty paths.
+
+    :attr:`generation` is incremented every time anything changes, so that
+    callers may cheaply tell if there have been any changes at all.
+
+    :attr:`pid` is the process it was made in; its thread doesn't exist in
+    any forked children, so it shouldn't be relied upon there.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paths = set()
+        self._dirty = set()
+        self.generation = 0
+        self.pid = os.getpid()
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    def watch(self, path):
+        """Start watching the given file."""
+        with self._lock:
+            if path in self._paths:
+                return
+            self._paths.add(path)
+        self._watch(path)
+
+    def _watch(self, path):
+        raise NotImplementedError()
+
+    def pop_dirty(self, path):
+        """Has the given file changed since this was last called for it?"""
+        # Check first, since taking the lock is more expensive.
+        if path not in self._dirty:
+            return False
+        with self._lock:
+            if path in self._dirty:
+                self._dirty.remove(path)
+                return True
+        return False
+
+    def _mark_dirty(self, paths):
+        with self._lock:
+            paths = [x for x in paths if x in self._paths]
+            if paths:
+                self._dirty.update(paths)
+                self.generation += 1
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(Watcher):
+
+    """Watches files by stat-ing them all from a background thread.
+
+    :param float interval: Seconds between scans.
+
+    """
+
+    def __init__(self, interval=1.0):
+        super(PollingWatcher, self).__init__()
+        self.interval = interval
+        self._mtimes = {}
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metatools.imports.watch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stat(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def _watch(self, path):
+        self._mtimes[path] = self._stat(path)
+
+    def poll(self):
+        """Scan every file once."""
+        changed = []
+        for path, last_mtime in self._mtimes.items():
+            mtime = self._stat(path)
+            if mtime != last_mtime:
+                self._mtimes[path] = mtime
+                changed.append(path)
+        if changed:
+            self._mark_dirty(changed)
+
+    def _run(self):
+        while not self._closed.is_set():
+            self.poll()
+            self._closed.wait(self.interval)
+
+    def close(self):
+        self._closed.set()
+
+
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+_IN_MASK = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+_event_header = struct.Struct('iIII')
+
+# The statfs f_type of filesystems which may be changed by other hosts.
+_NETWORK_FILESYSTEMS = frozenset((
+    0x6969,     # NFS
+    0x517b,     # SMB
+    0xff534d42, # CIFS
+    0xfe534d42, # SMB2
+    0x5346414f, # AFS
+    0x73757245, # Coda
+    0x00c36400, # Ceph
+    0x01161970, # GFS2
+    0x0bd00bd0, # Lustre
+    0x01021997, # 9P
+    0x65735546, # FUSE (e.g. sshfs)
+))
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+def is_network_path(path):
+    """Is the given path on a network filesystem (as far as Linux's
+    ``statfs`` can tell)? Other platforms always return ``False``."""
+    try:
+        libc = _get_libc()
+    except OSError:
+        return False
+    # struct statfs starts with the filesystem type as a long.
+    buf = ctypes.create_string_buffer(512)
+    if libc.statfs(path, buf) < 0:
+        return False
+    return (ctypes.c_long.from_buffer(buf).value & 0xffffffff) in _NETWORK_FILESYSTEMS
+
+
+class InotifyWatcher(Watcher):
+
+    """Watches files via inotify on the directories which contain them.
+
+    Files on network filesystems (see :func:`is_network_path`) are polled
+    instead, since changes made to them by other hosts aren't seen by inotify.
+
+    :param float interval: Seconds between polls of those files.
+
+    """
+
+    def __init__(self, interval=1.0):
+        super(InotifyWatcher, self).__init__()
+
+        self.interval = interval
+        self._network = {} # Maps directories to if they are on a network filesystem.
+        self._mtimes = {} # Maps polled paths to their last modification times.
+
+        self._libc = _get_libc()
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        self._directories = {} # Maps directories to watch descriptors.
+        self._descriptors = {} # Maps watch descriptors to directories.
+        self._aliases = {} # Maps absolute paths to how they were given.
+
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metatools.imports.watch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self, path):
+        abs_path = os.path.abspath(path)
+        directory = os.path.dirname(abs_path)
+        with self._lock:
+            network = self._network.get(directory)
+            if network is None:
+                network = self._network[directory] = is_network_path(directory)
+            if network:
+                self._mtimes[path] = self._stat(path)
+                return
+            self._aliases.setdefault(abs_path, set()).add(path)
+            if directory in self._directories:
+                return
+            wd = self._libc.inotify_add_watch(self._fd, directory, _IN_MASK)
+            if wd < 0:
+                # We can't watch it, so forget it; it will be stat-ed as usual.
+                self._paths.discard(path)
+                return
+            self._directories[directory] = wd
+            self._descriptors[wd] = directory
+
+    def _read_events(self):
+        try:
+            buf = os.read(self._fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        changed = []
+        overflowed = False
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = _event_header.unpack_from(buf, offset)
+            offset += _event_header.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & _IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+
+            directory = self._descriptors.get(wd)
+            if directory is None:
+                continue
+
+            if mask & _IN_IGNORED:
+                # The directory itself went away. Forget its files, so that
+                # they are stat-ed (and watched again once it is back) as if
+                # they were new.
+                with self._lock:
+                    self._descriptors.pop(wd, None)
+                    self._directories.pop(directory, None)
+                    for abs_path in [x for x in self._aliases if os.path.dirname(x) == directory]:
+                        for path in self._aliases.pop(abs_path):
+                            self._paths.discard(path)
+                            self._dirty.discard(path)
+                    self.generation += 1
+                continue
+
+            changed.extend(self._aliases.get(os.path.join(directory, name), ()))
+
+        if overflowed:
+            # We lost events, so assume everything changed.
+            changed = list(self._paths)
+        if changed:
+            self._mark_dirty(changed)
+
+    def _stat(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def poll(self):
+        """Stat every file on a network filesystem once."""
+        changed = []
+        for path, last_mtime in self._mtimes.items():
+            mtime = self._stat(path)
+            if mtime != last_mtime:
+                self._mtimes[path] = mtime
+                changed.append(path)
+        if changed:
+            self._mark_dirty(changed)
+
+    def _run(self):
+        next_poll = time.time() + self.interval
+        while not self._closed.is_set():
+            try:
+                readable, _, _ = select.select([self._fd], [], [], min(0.5, self.interval))
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable and not self._closed.is_set():
+                self._read_events()
+            if self._mtimes and time.time() >= next_poll:
+                self.poll()
+                next_poll = time.time() + self.interval
+        os.close(self._fd)
+
+    def close(self):
+        self._closed.set()
+
+
+def get_watcher(backend='auto', **kwargs):
+    """Construct a :class:`Watcher`.
+
+    :param str backend: ``"inotify"``, ``"poll"``, or ``"auto"``.
+    :param kwargs: Passed to the watcher's constructor.
+
+    """
+    if backend == 'auto':
+        try:
+            _get_libc()
+        except OSError:
+            backend = 'poll'
+        else:
+            backend = 'inotify'
+    if backend == 'inotify':
+        return InotifyWatcher(**kwargs)
+    if backend == 'poll':
+        return PollingWatcher(**kwargs)
+    raise ValueError('unknown watcher backend %r' % backend)
@@ -1,38 +1,191 @@
-import subprocess
-import re
+"""A git ``pre-receive`` hook which reports new pyflakes warnings in a push.
+
+Every changed Python file is read (before and after) through a single
+``git cat-file --batch`` process, and checked by pyflakes in a pool of worker
+processes; only a couple of files per worker are read ahead at any time.
+Only warnings which the push introduces are reported, and the hook gives up
+after a time budget (``--timeout``, or ``METATOOLS_LINT_TIMEOUT`` seconds) so
+that a huge push is never blocked for long. It never rejects, even if
+something goes wrong.
+
+"""
+
+import _ast
+import collections
+import itertools
+import multiprocessing
+import optparse
 import os
 import sys
+import time
+
+from metatools.git import BlobReader, changed_paths, EMPTY_TREE, NULL_SHA
+
+
+def iter_tasks(reader, updates):
+    """Iterate over the sources to check for the given ref updates.
+
+    :param updates: List of ``(old_sha, new_sha, ref_name)``.
+    :returns: An iterator of ``(ref_name, filename, old_source, new_source)``,
+        where ``old_source`` is ``None`` for new files.
+
+    """
+
+    for old_sha, new_sha, ref_name in updates:
+
+        filenames = [x for x in changed_paths(old_sha, new_sha) if x.endswith('.py')]
+
+        # Interleaved, so that each file's sources are read together.
+        old_sha = old_sha if old_sha != NULL_SHA else EMPTY_TREE
+        names = []
+        for filename in filenames:
+            names.append('%s:%s' % (old_sha, filename))
+            names.append('%s:%s' % (new_sha, filename))
+
+        blobs = reader.read_many(names)
+        for filename in filenames:
+            _, old_source = next(blobs)
+            _, new_source = next(blobs)
+            yield ref_name, filename, old_source, new_source or ''
+
+
+def check_source(source, filename):
+    """Run pyflakes on the given source.
+
+    :returns: A sorted list of ``(lineno, message)``.
+
+    """
+
+    from pyflakes import checker
+
+    try:
+        tree = compile(source, filename, 'exec', _ast.PyCF_ONLY_AST)
+    except SyntaxError as e:
+        return [(e.lineno or 0, 'syntax error: %s' % e.msg)]
+
+    w = checker.Checker(tree, filename)
+    return sorted((m.lineno, m.message % m.message_args) for m in w.messages)
+
 
+def _check_task(task):
+    ref_name, filename, old_source, new_source = task
+    try:
+        old = check_source(old_source, filename) if old_source is not None else []
+        return ref_name, filename, new_messages(old, check_source(new_source, filename))
+    except Exception as e:
+        # e.g. null bytes, or pyflakes itself failing; this must not reject.
+        return ref_name, filename, [(0, 'could not check: %s: %s' % (e.__class__.__name__, e))]
+
+
+def new_messages(old, new):
+    """Get the messages in ``new`` which are not in ``old``.
+
+    Line numbers are ignored when matching them up, since edits move them.
+
+    """
+    remaining = collections.Counter(message for _, message in old)
+    found = []
+    for lineno, message in new:
+        if remaining[message]:
+            remaining[message] -= 1
+        else:
+            found.append((lineno, message))
+    return found
 
-def call_output(cmd, stdin=None):
-    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    return proc.communicate(stdin or '')[0]
 
 def main():
 
-    changed = set()
+    opt_parser = optparse.OptionParser(usage='%prog [options] < "old_sha new_sha ref_name" lines')
+    opt_parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count(),
+        help='number of processes to run pyflakes in')
+    opt_parser.add_option('-t', '--timeout', type='float', default=float(os.environ.get('METATOOLS_LINT_TIMEOUT') or 30),
+        help='seconds to spend before giving up on the rest')
+    opts, args = opt_parser.parse_args()
+
+    try:
+        import pyflakes.checker
+    except ImportError:
+        print 'PyFlakes is not installed; skipping.'
+        return
+
+    try:
+        _run(opts)
+    except Exception as e:
+        # The hook only reports, so it must never reject a push.
+        print 'PyFlakes failed: %s: %s' % (e.__class__.__name__, e)
+
+
+def _iter_results(tasks, jobs, deadline):
+    """Check the tasks until they run out, or we pass the deadline.
+
+    Tasks are given to the pool a window at a time, so that only a couple of
+    files per job are ever read ahead.
+
+    :returns: An iterator of ``(ref_name, filename, messages)``; it raises
+        :class:`multiprocessing.TimeoutError` when it runs out of time.
 
-    # Collect all of the files which have been changed.
+    """
+
+    if jobs <= 1:
+        for task in tasks:
+            if time.time() > deadline:
+                raise multiprocessing.TimeoutError()
+            yield _check_task(task)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        while True:
+            window = list(itertools.islice(tasks, 2 * jobs))
+            if not window:
+                return
+            results = pool.imap_unordered(_check_task, window)
+            for _ in window:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise multiprocessing.TimeoutError()
+                yield results.next(remaining)
+    finally:
+        pool.terminate()
+
+
+def _run(opts):
+
+    deadline = time.time() + opts.timeout
+
+    updates = []
     for line in sys.stdin:
-        old_sha, new_sha, new_name = line.strip().split()
-        proc = subprocess.Popen(['git', 'diff', '--name-only', old_sha, new_sha],
-            stdout=subprocess.PIPE)
-        filenames = [x.strip() for x in proc.stdout if x.strip().endswith('.py')]
+        old_sha, new_sha, ref_name = line.strip().split()
+        # Skip deleted refs.
+        if new_sha != NULL_SHA:
+            updates.append((old_sha, new_sha, ref_name))
+
+    # Maps (ref_name, filename) to new messages.
+    checked = {}
+    timed_out = False
 
-        print 'PyFlakes for %s:' % new_name
-        for filename in sorted(filenames):
+    reader = BlobReader()
+    try:
+        for ref_name, filename, messages in _iter_results(iter_tasks(reader, updates), opts.jobs, deadline):
+            checked[(ref_name, filename)] = messages
+    except multiprocessing.TimeoutError:
+        timed_out = True
+    finally:
+        reader.close()
 
-            print '\t%s' % filename
+    for old_sha, new_sha, ref_name in updates:
 
-            old_src = call_output(['git', 'cat-file', 'blob', '%s:%s' % (old_sha, filename)])
-            new_src = call_output(['git', 'cat-file', 'blob', '%s:%s' % (new_sha, filename)])
+        print 'PyFlakes for %s:' % ref_name
 
-            old_flakes = call_output(['pyflakes'], old_src)
-            new_flakes = call_output(['pyflakes'], new_src)
-            print old_flakes.strip()
-            print new_flakes.strip()
+        for (ref_name_, filename), messages in sorted(checked.iteritems()):
+            if ref_name_ == ref_name and messages:
+                print '\t%s' % filename
+                for lineno, message in messages:
+                    print '\t\t%d: %s' % (lineno, message)
+
+    if timed_out:
+        print 'PyFlakes ran out of time after %.1fs; some files were not checked.' % opts.timeout
 
 
 if __name__ == '__main__':
     main()
-
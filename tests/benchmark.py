@@ -0,0 +1,292 @@
+"""Benchmarks of the hot paths in :mod:`metatools.imports`.
+
+Generates a synthetic package tree, times reloading, discovery, graphing, and
+rewriting over it, and writes the results as JSON so that they may be compared
+between commits::
+
+    python tests/benchmark.py --modules 500 --output before.json
+    git checkout other-branch
+    python tests/benchmark.py --modules 500 --output after.json
+
+Every timing is the best of ``--repeat`` runs, in seconds.
+
+"""
+
+from __future__ import print_function
+
+import contextlib
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '..', '..')))
+
+from metatools.imports import discovery
+from metatools.imports import entry_points
+from metatools.imports import graph
+from metatools.imports import rewrite
+from metatools.imports.reload import autoreload
+
+
+def generate_tree(root, modules=200, depth=3, fanout=4, cycles=0.05, seed=0):
+    """Write a synthetic package tree, and return the names of its modules.
+
+    :param int modules: How many (non-package) modules to create.
+    :param int depth: How deep the packages are nested.
+    :param int fanout: How many other modules each one imports.
+    :param float cycles: The chance that each module imports a later one,
+        creating an import cycle.
+
+    """
+
+    rand = random.Random(seed)
+
+    # Packages nest like benchpkg.p0.p1..., with a few at each level.
+    packages = ['benchpkg']
+    for level in range(depth - 1):
+        for parent in list(packages):
+            if parent.count('.') == level:
+                packages.extend('%s.p%d' % (parent, i) for i in range(2))
+
+    names = ['%s.mod%d' % (rand.choice(packages), i) for i in range(modules)]
+
+    for package in packages:
+        path = os.path.join(root, *package.split('.'))
+        os.makedirs(path)
+        with open(os.path.join(path, '__init__.py'), 'w') as fh:
+            fh.write('"""Package %s."""\n' % package)
+
+    for i, name in enumerate(names):
+
+        deps = rand.sample(names[:i], min(i, fanout))
+        if i + 1 < len(names) and rand.random() < cycles:
+            deps.append(rand.choice(names[i + 1:]))
+
+        lines = ['"""Module %s."""' % name, '', 'import os', 'import sys', '']
+        # Plain imports, since the cycles would break "from" imports.
+        for dep in deps:
+            lines.append('import %s' % dep)
+        lines.extend(['', 'VALUE = %d' % i, ''])
+        for j in range(10):
+            lines.append('def func%d(arg):' % j)
+            lines.append('    # benchpkg in a comment should not be rewritten.')
+            for dep in deps:
+                lines.append('    arg += %s.VALUE' % dep)
+            lines.append('    return os.path.join(str(arg), %r)' % name)
+            lines.append('')
+
+        path = os.path.join(root, *name.split('.')) + '.py'
+        with open(path, 'w') as fh:
+            fh.write('\n'.join(lines))
+
+    with open(os.path.join(root, 'benchroot.py'), 'w') as fh:
+        fh.write(''.join('import %s\n' % name for name in names))
+
+    return names
+
+
+@contextlib.contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def best_of(repeat, func, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        with quiet():
+            func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def iter_sources(root):
+    for path in graph.iter_paths(root):
+        with open(path) as fh:
+            yield path, fh.read()
+
+
+def bench_parse(results, root, repeat):
+
+    sources = [source for path, source in iter_sources(root)]
+    size = sum(len(x) for x in sources)
+
+    for deep in (False, True):
+        elapsed = best_of(repeat, lambda: [discovery.parse_imports(x, deep=deep) for x in sources])
+        results['parse_imports_%s' % ('deep' if deep else 'top_level')] = {
+            'seconds': elapsed,
+            'files_per_second': len(sources) / elapsed,
+            'bytes_per_second': size / elapsed,
+        }
+
+
+def bench_graph(results, root, repeat):
+
+    class Opts(object):
+        exclude = None
+        implied = True
+        jobs = None
+
+    elapsed = best_of(repeat, lambda: list(graph.iter_dot(Opts(), [root])))
+    results['graph_iter_dot'] = {'seconds': elapsed}
+
+
+def bench_rewrite(results, root, repeat):
+
+    sources = [(rewrite.module_name_for_path(path), source) for path, source in iter_sources(root)]
+    lines = sum(source.count('\n') for name, source in sources)
+    mapping = {'benchpkg': 'newpkg'}
+
+    for engine in ('regex', 'tree'):
+        elapsed = best_of(repeat, lambda: [rewrite.rewrite(source, mapping, name, engine=engine) for name, source in sources])
+        results['rewrite' if engine == 'regex' else 'rewrite_' + engine] = {
+            'seconds': elapsed,
+            'lines_per_second': lines / elapsed,
+        }
+
+
+def bench_rewrite_small(results, root, repeat):
+
+    # Tiny sources, as a pre-receive hook would see, so that per-call
+    # overhead dominates; every one needs parsing.
+    sources = ['import benchpkg.mod%d\nbenchpkg.mod%d.func(%d)\n' % (i, i, i) for i in range(1000)]
+    mapping = {'benchpkg': 'newpkg'}
+
+    elapsed = best_of(repeat, lambda: [rewrite.rewrite(source, mapping, 'benchroot') for source in sources])
+    results['rewrite_small'] = {
+        'seconds': elapsed,
+        'microseconds_per_file': elapsed / len(sources) * 1e6,
+    }
+
+
+def bench_autoreload(results, root, names, repeat):
+
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    sys.path.insert(0, root)
+    try:
+
+        with quiet():
+            import benchroot
+            autoreload(benchroot)
+
+        elapsed = best_of(repeat, lambda: autoreload(benchroot))
+        results['autoreload_no_change'] = {'seconds': elapsed, 'modules': len(names) + 1}
+
+        # The first module is the one most depended upon.
+        path = os.path.join(root, *names[0].split('.')) + '.py'
+        mtimes = [time.time()]
+        def touch():
+            mtimes[0] += 10
+            os.utime(path, (mtimes[0], mtimes[0]))
+
+        elapsed = best_of(repeat, lambda: autoreload(benchroot), setup=touch)
+        results['autoreload_one_change'] = {'seconds': elapsed}
+
+        # The same specs over and over, as a job dispatcher would.
+        specs = ['%s:func%d(%d, name=%r)' % (name, i % 10, i, name) for i, name in enumerate(names)]
+        def load():
+            for spec in specs:
+                entry_points.load_entry_point(spec, with_args=True)
+        load()
+        elapsed = best_of(repeat, load)
+        results['entry_points'] = {
+            'seconds': elapsed,
+            'microseconds_per_call': elapsed / len(specs) * 1e6,
+        }
+
+    finally:
+        sys.path.remove(root)
+        sys.dont_write_bytecode = dont_write_bytecode
+        for name in list(sys.modules):
+            if name == 'benchroot' or name.split('.')[0] == 'benchpkg':
+                del sys.modules[name]
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w'),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+BENCHMARKS = ['autoreload', 'parse', 'graph', 'rewrite', 'rewrite_small']
+
+
+def main():
+
+    opt_parser = optparse.OptionParser(usage='%prog [options] [benchmark...]')
+    opt_parser.add_option('-m', '--modules', type='int', default=200)
+    opt_parser.add_option('-d', '--depth', type='int', default=3)
+    opt_parser.add_option('-f', '--fanout', type='int', default=4)
+    opt_parser.add_option('-c', '--cycles', type='float', default=0.05)
+    opt_parser.add_option('-r', '--repeat', type='int', default=3)
+    opt_parser.add_option('-s', '--seed', type='int', default=0)
+    opt_parser.add_option('-o', '--output', help='write JSON here instead of stdout')
+    opts, args = opt_parser.parse_args()
+
+    for name in args:
+        if name not in BENCHMARKS:
+            opt_parser.error('unknown benchmark %r; choose from %s' % (name, ', '.join(BENCHMARKS)))
+    benchmarks = args or BENCHMARKS
+
+    params = dict(
+        modules=opts.modules,
+        depth=opts.depth,
+        fanout=opts.fanout,
+        cycles=opts.cycles,
+        seed=opts.seed,
+    )
+
+    root = tempfile.mkdtemp(prefix='metatools-benchmark.')
+    try:
+
+        names = generate_tree(root, **params)
+        results = {}
+
+        for name in benchmarks:
+            print('# running', name, file=sys.stderr)
+            if name == 'autoreload':
+                bench_autoreload(results, root, names, opts.repeat)
+            else:
+                globals()['bench_' + name](results, root, opts.repeat)
+
+    finally:
+        shutil.rmtree(root)
+
+    output = json.dumps({
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': dict(params, repeat=opts.repeat),
+        'results': results,
+    }, indent=4, sort_keys=True)
+
+    if opts.output:
+        with open(opts.output, 'w') as fh:
+            fh.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -151,3 +151,50 @@ class TestFunctionDecorator(TestCase):
         self.assertEqual(w[0].message.args[0], 'test_deprecate.func has been deprecated')
         self.assertEqual(w[0].lineno, 3)
         self.assertEqual(w[0].filename, '<string>')
+
+
+class TestWarnOnce(TestCase):
+
+    def setUp(self):
+        self.deprecate_module = sys.modules['metatools.deprecate']
+        self.deprecate_module._ONCE = True
+        self.deprecate_module._reported.clear()
+
+    def tearDown(self):
+        self.deprecate_module._ONCE = False
+        self.deprecate_module._reported.clear()
+
+    def test_once_per_call_site(self):
+
+        class Example(object):
+            new = 1
+            old = renamed_attr('new')
+
+        class Subclass(Example):
+            pass
+
+        def new(a, b):
+            return a + b
+        old = renamed_func(new, 'old', __name__)
+
+        @deprecate
+        def func():
+            pass
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            for i in range(3):
+                Subclass().old
+                old(1, 2)
+                func()
+            Example.old
+            func()
+
+        self.assertEqual([x.message.args[0] for x in w], [
+            'Subclass.old was renamed to new',
+            'test_deprecate.old was renamed to test_deprecate.new',
+            'test_deprecate.func has been deprecated',
+            'Example.old was renamed to new',
+            'test_deprecate.func has been deprecated',
+        ])
+        self.assertEqual(Example.__dict__['old'].old_name(Subclass), 'old')
@@ -0,0 +1,175 @@
+import __builtin__
+import shutil
+import tempfile
+import time
+
+from common import *
+
+from metatools.imports import entry_points
+from metatools.imports.entry_points import load_entry_point, EntryPointMalformed, EntryPointAttributeError, EntryPointImportError
+from metatools.imports.entry_points import load_entry_points, resolve_lazy_entry_points, iter_untouched_entry_points
+from metatools.imports.reload import _reload_times
+
+reload_module = sys.modules['metatools.imports.reload']
+
+
+class TestEntryPoints(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = True
+        sys.path.insert(0, self.root)
+        self.mtime = time.time() - 100
+        entry_points.clear_cache()
+
+    def tearDown(self):
+        sys.path.remove(self.root)
+        sys.dont_write_bytecode = self.dont_write_bytecode
+        for name, module in list(sys.modules.items()):
+            if (getattr(module, '__file__', None) or '').startswith(self.root):
+                del sys.modules[name]
+                _reload_times.pop(name, None)
+        shutil.rmtree(self.root)
+        entry_points.clear_cache()
+
+    def write(self, name, source):
+        path = os.path.join(self.root, name)
+        with open(path, 'w') as fh:
+            fh.write(source)
+        self.mtime += 10
+        os.utime(path, (self.mtime, self.mtime))
+
+    def test_basics(self):
+
+        self.write('ep_basics.py', 'class A(object):\n    def method(self): pass\ndef func(*args, **kwargs): pass\n')
+        import ep_basics
+
+        self.assertIs(load_entry_point('ep_basics:func'), ep_basics.func)
+        self.assertEqual(load_entry_point('ep_basics:A.method'), ep_basics.A.method)
+
+        func, args, kwargs = load_entry_point('ep_basics:func(1, "two", three=[3])', with_args=True)
+        self.assertIs(func, ep_basics.func)
+        self.assertEqual(args, [1, 'two'])
+        self.assertEqual(kwargs, {'three': [3]})
+
+        self.assertEqual(load_entry_point('ep_basics:func', with_args=True), (ep_basics.func, (), {}))
+
+        self.assertRaises(EntryPointMalformed, load_entry_point, 'ep_basics.func')
+        self.assertRaises(EntryPointAttributeError, load_entry_point, 'ep_basics:missing')
+        self.assertRaises(ValueError, load_entry_point, 'ep_basics:func(1)')
+
+    def test_cache(self):
+
+        self.write('ep_cache.py', 'def func(): return 1\n')
+        func = load_entry_point('ep_cache:func(x=[])', with_args=True)[0]
+        self.assertIn('ep_cache:func(x=[])', entry_points._cache)
+
+        # Modifying what we are given (or within it) doesn't modify the cache.
+        _, args, kwargs = load_entry_point('ep_cache:func(x=[])', with_args=True)
+        kwargs['y'] = 2
+        kwargs['x'].append(99)
+        self.assertEqual(load_entry_point('ep_cache:func(x=[])', with_args=True), (func, [], {'x': []}))
+
+        # Reloading the module invalidates it.
+        self.write('ep_cache.py', 'def func(): return 2\n')
+        reload_module.reload(sys.modules['ep_cache'])
+        func = load_entry_point('ep_cache:func(x=[])', with_args=True)[0]
+        self.assertEqual(func(), 2)
+
+        # As does replacing it.
+        self.write('ep_cache.py', 'def func(): return 3\n')
+        del sys.modules['ep_cache']
+        self.assertEqual(load_entry_point('ep_cache:func(x=[])', with_args=True)[0](), 3)
+
+        # As does the builtin reload.
+        self.write('ep_cache.py', 'def func(): return 5\n')
+        __builtin__.reload(sys.modules['ep_cache'])
+        self.assertEqual(load_entry_point('ep_cache:func(x=[])', with_args=True)[0](), 5)
+
+        # And monkeypatching.
+        sys.modules['ep_cache'].func = lambda: 6
+        self.assertEqual(load_entry_point('ep_cache:func(x=[])', with_args=True)[0](), 6)
+
+        # As does autoreloading it (once it has seen the source).
+        load_entry_point('ep_cache:func(x=[])', reload=None, with_args=True)
+        self.write('ep_cache.py', 'def func(): return 4\n')
+        self.assertEqual(load_entry_point('ep_cache:func(x=[])', reload=None, with_args=True)[0](), 4)
+
+    def test_lru(self):
+
+        self.write('ep_lru.py', 'a = b = c = None\n')
+        old_size = entry_points._CACHE_SIZE
+        entry_points._CACHE_SIZE = 2
+        try:
+            for name in 'abca':
+                load_entry_point('ep_lru:' + name)
+            self.assertEqual(list(entry_points._cache), ['ep_lru:c', 'ep_lru:a'])
+        finally:
+            entry_points._CACHE_SIZE = old_size
+
+    def test_lazy(self):
+
+        self.write('ep_lazy.py', 'VALUE = 1\ndef func(*args, **kwargs): return args, kwargs\n')
+
+        func, args, kwargs = load_entry_point('ep_lazy:func(1, two=2)', with_args=True, lazy=True)
+        value = load_entry_point('ep_lazy:VALUE', lazy=True)
+        missing = load_entry_point('ep_lazy_missing:func', lazy=True)
+        self.assertEqual((args, kwargs), ([1], {'two': 2}))
+        self.assertRaises(EntryPointMalformed, load_entry_point, 'ep_lazy.func', lazy=True)
+        self.assertFalse('ep_lazy' in sys.modules)
+
+        self.assertEqual(func(*args, **kwargs), ((1, ), {'two': 2}))
+        self.assertTrue('ep_lazy' in sys.modules)
+        self.assertEqual(func.__name__, 'func')
+        self.assertRaises(EntryPointImportError, missing)
+
+        untouched = set(iter_untouched_entry_points())
+        self.assertTrue('ep_lazy:VALUE' in untouched)
+        self.assertFalse('ep_lazy:func' in untouched)
+
+        # Resolving doesn't count as touching.
+        errors = resolve_lazy_entry_points([value, missing])
+        self.assertEqual(list(errors), ['ep_lazy_missing:func'])
+        self.assertTrue(isinstance(errors['ep_lazy_missing:func'], EntryPointImportError))
+        self.assertTrue('loaded' in repr(value))
+        self.assertTrue('ep_lazy:VALUE' in set(iter_untouched_entry_points()))
+
+        # They go away with their proxies.
+        del value
+        self.assertFalse('ep_lazy:VALUE' in set(iter_untouched_entry_points()))
+
+    def test_bulk(self):
+
+        os.makedirs(os.path.join(self.root, 'ep_bulk'))
+        self.write('ep_bulk/__init__.py', '')
+        self.write('ep_bulk/a.py', 'import ep_bulk.b\nfrom ep_bulk.b import VALUE\ndef func(): return VALUE\n')
+        self.write('ep_bulk/b.py', 'import ep_bulk.c\nVALUE = 1\n')
+        self.write('ep_bulk/c.py', 'import ep_bulk_log\nep_bulk_log.order.append(__name__)\n')
+        self.write('ep_bulk/d.py', 'import ep_bulk_log\nep_bulk_log.order.append(__name__)\nraise RuntimeError("broken")\n')
+        self.write('ep_bulk_log.py', 'order = []\n')
+
+        order = entry_points._prefetch_imports(['ep_bulk.a', 'ep_bulk.c', 'ep_bulk.b'], 2)
+        self.assertEqual(order, ['ep_bulk.c', 'ep_bulk.b', 'ep_bulk.a'])
+        self.assertEqual([x for x in sys.modules if x.startswith('ep_bulk')], [])
+
+        results, errors = load_entry_points([
+            'ep_bulk.a:func',
+            'ep_bulk.a:func(1)',
+            'ep_bulk.b:VALUE',
+            'ep_bulk.b:missing',
+            'ep_bulk.d:anything',
+            'ep_bulk_missing:func',
+            'malformed',
+        ], threads=2)
+
+        import ep_bulk.a
+        self.assertEqual(results, {'ep_bulk.a:func': ep_bulk.a.func, 'ep_bulk.b:VALUE': 1})
+        self.assertEqual(sorted(errors), ['ep_bulk.a:func(1)', 'ep_bulk.b:missing', 'ep_bulk.d:anything', 'ep_bulk_missing:func', 'malformed'])
+        self.assertTrue(isinstance(errors['ep_bulk.b:missing'], EntryPointAttributeError))
+        self.assertTrue(isinstance(errors['ep_bulk.d:anything'], RuntimeError))
+        self.assertTrue(isinstance(errors['ep_bulk_missing:func'], EntryPointImportError))
+        self.assertTrue(isinstance(errors['malformed'], EntryPointMalformed))
+
+        results, errors = load_entry_points(['ep_bulk.a:func(1)'], with_args=True)
+        self.assertEqual(results, {'ep_bulk.a:func(1)': (ep_bulk.a.func, [1], {})})
@@ -0,0 +1,112 @@
+import shutil
+import subprocess
+import tempfile
+
+from common import *
+
+from metatools import git
+from metatools.imports import rewrite as rewrite_module
+
+
+class GitTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.git('init', '-q')
+        self.write('pkg/__init__.py', '')
+        self.write('pkg/a.py', 'import a\na.func()\n')
+        self.write('pkg/b.py', 'import os\n')
+        self.write('README', 'Hello.\n')
+        self.first = self.commit()
+        self.write('pkg/b.py', 'import a\n')
+        self.write('pkg/c.py', 'from a import func\n')
+        self.write('scripts/d.py', 'import a\n')
+        self.git('rm', '-q', 'README')
+        self.second = self.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def git(self, *args):
+        return subprocess.check_output(
+            ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com'] + list(args),
+            cwd=self.root,
+        ).strip()
+
+    def write(self, name, source):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(source)
+
+    def commit(self):
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', 'Test.')
+        return self.git('rev-parse', 'HEAD')
+
+
+class TestGit(GitTestCase):
+
+    def test_changed_paths(self):
+        self.assertEqual(git.changed_paths(self.first, self.second, self.root), [
+            'pkg/b.py', 'pkg/c.py', 'scripts/d.py',
+        ])
+        self.assertEqual(git.changed_paths(git.NULL_SHA, self.first, self.root), [
+            'README', 'pkg/__init__.py', 'pkg/a.py', 'pkg/b.py',
+        ])
+        self.assertEqual(git.parse_range('A..B'), ('A', 'B'))
+        self.assertEqual(git.parse_range('A'), ('A^', 'A'))
+
+    def test_blob_reader(self):
+        with git.BlobReader(self.root, batch_size=2) as reader:
+
+            self.assertEqual(reader.read('%s:pkg/b.py' % self.first), 'import os\n')
+            self.assertEqual(reader.read('%s:README' % self.second), None)
+
+            names = ['%s:pkg/%s.py' % (rev, x) for rev in (self.first, self.second) for x in 'abc']
+            self.assertEqual(list(reader.read_many(names)), zip(names, [
+                'import a\na.func()\n', 'import os\n', None,
+                'import a\na.func()\n', 'import a\n', 'from a import func\n',
+            ]))
+
+            # Stopping part way through a batch leaves the reader usable.
+            for name, content in reader.read_many(names):
+                break
+            self.assertEqual(reader.read('%s:pkg/c.py' % self.second), 'from a import func\n')
+
+    def test_rewrite(self):
+
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            sources = list(rewrite_module.iter_git_sources('%s..%s' % (self.first, self.second), ['pkg/']))
+            self.assertEqual(sources, [
+                ('pkg/b.py', 'import a\n', 'pkg.b'),
+                ('pkg/c.py', 'from a import func\n', 'pkg.c'),
+            ])
+            sources = list(rewrite_module.iter_git_sources(self.second))
+            self.assertEqual([x[::2] for x in sources], [('pkg/b.py', 'pkg.b'), ('pkg/c.py', 'pkg.c'), ('scripts/d.py', 'd')])
+        finally:
+            os.chdir(cwd)
+
+        rewrite_module._init_worker({'a': 'x'}, {})
+        results = map(rewrite_module._process_blob, sources)
+        self.assertEqual([x[3] for x in results], ['import x\n', 'from x import func\n', 'import x\n'])
+
+    def test_rewrite_root_package(self):
+
+        self.write('__init__.py', '')
+        self.write('pkg/b.py', 'import a.b\n')
+        self.commit()
+
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            sources = list(rewrite_module.iter_git_sources('HEAD'))
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(sources, [('__init__.py', '', '__init__'), ('pkg/b.py', 'import a.b\n', 'pkg.b')])
+
+        self.assertEqual(rewrite_module.module_name_for_path('pkg/a.py', set(['', 'pkg']).__contains__), 'pkg.a')
+        self.assertEqual(rewrite_module.module_name_for_path('/pkg/a.py', set(['/', '/pkg']).__contains__), 'pkg.a')
@@ -1,6 +1,12 @@
+import ast
+import shutil
+import tempfile
+
 from common import *
 
+from metatools.imports.cache import ImportCache, set_import_cache
 from metatools.imports.discovery import *
+from metatools.imports.discovery import _find_top_level_imports, _Ambiguous
 
 
 class TestDiscovery(TestCase):
@@ -117,4 +123,146 @@ class TestDiscovery(TestCase):
         self.assertTrue(path_is_in_directories('/path/to/file', ['/path/to/file']))
         self.assertFalse(path_is_in_directories('/path/to/file', ['/path/to/file/nope']))
         self.assertFalse(path_is_in_directories('/path/to/file', ['/another/path']))
+        self.assertFalse(path_is_in_directories('/path/to/file', ['/path/to/fi']))
+
+    def test_directory_index(self):
+        index = DirectoryIndex(['/a/b/c', '/x/y', '/x/y/z', '/p/q/r'])
+        index.add('/p/q')
+        self.assertTrue('/a/b/c/d.py' in index)
+        self.assertTrue('/a/b/c' in index)
+        self.assertTrue('/x/y/file.py' in index)
+        self.assertTrue('/p/q/other.py' in index)
+        self.assertTrue('/a/b/../b/c/d.py' in index)
+        self.assertFalse('/a/b/d.py' in index)
+        self.assertFalse('/a/b/cc/d.py' in index)
+        self.assertFalse('/x' in index)
+        self.assertFalse('/' in index)
+        self.assertTrue('/anything' in DirectoryIndex(['/']))
+
+
+
+class TestTopLevelFastPath(TestCase):
+
+    def assertMatchesAST(self, source):
+        nodes = _find_top_level_imports(source)
+        expected = [x for x in ast.parse(source).body if isinstance(x, (ast.Import, ast.ImportFrom))]
+        self.assertEqual(
+            [ast.dump(x) for x in nodes],
+            [ast.dump(x) for x in expected],
+        )
+
+    def test_tricky(self):
+        self.assertMatchesAST(dedent('''
+            """Docstring
+
+            import not_an_import
+            """
+
+            from a import (
+                b, # A comment (with parens.
+                c as d,
+            )
+            from x import \\
+                y
+
+            import e
+            if True: import g
+
+            def func():
+                import h
+
+            s = \'\'\'
+            from not_an import import_
+            \'\'\'
+            t = 'string \\
+            import nope'
+            from . import *
+        '''))
+
+    def test_ambiguous(self):
+        self.assertRaises(_Ambiguous, _find_top_level_imports, 'x = 1; import os\n')
+        self.assertRaises(_Ambiguous, _find_top_level_imports, 'import (\n')
+        self.assertEqual(parse_imports('x = 1; import os\n'), ['os'])
+
+    def test_sources(self):
+        root = os.path.abspath(os.path.join(__file__, '..', '..'))
+        for dir_name, dir_names, file_names in os.walk(root):
+            for file_name in file_names:
+                if not file_name.endswith('.py'):
+                    continue
+                try:
+                    self.assertMatchesAST(open(os.path.join(dir_name, file_name)).read())
+                except _Ambiguous:
+                    pass
+
+
+class TestImportCache(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = ImportCache(os.path.join(self.root, 'cache', 'imports.sqlite'))
+        set_import_cache(self.cache)
+
+    def tearDown(self):
+        set_import_cache(None)
+        shutil.rmtree(self.root)
+
+    def write(self, source, mtime):
+        path = os.path.join(self.root, 'module.py')
+        with open(path, 'w') as fh:
+            fh.write(source)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_roundtrip(self):
+
+        path = self.write('import os\nfrom . import sibling\ndef func():\n    import deep\n', 1000)
+        self.assertEqual(parse_file_imports(path, 'package', 'package.module'), [
+            'os', 'package', 'package.sibling',
+        ])
+        self.assertEqual(self.cache.get(path), ['os', '.', '.sibling'])
+        self.assertEqual(self.cache.get(path, deep=True), None)
+
+        self.assertEqual(parse_file_imports(path, deep=True), [
+            'os', '.', '.sibling', 'deep',
+        ])
+        self.assertEqual(self.cache.get(path, deep=True), ['os', '.', '.sibling', 'deep'])
+
+        # Served from the cache.
+        self.cache.set(path, False, ['fake'])
+        self.assertEqual(parse_file_imports(path), ['fake'])
+
+        # Changing the file invalidates it.
+        self.write('import sys\n', 2000)
+        self.assertEqual(self.cache.get(path), None)
+        self.assertEqual(parse_file_imports(path), ['sys'])
+
+    def test_empty(self):
+        path = self.write('x = 1\n', 1000)
+        self.assertEqual(parse_file_imports(path), [])
+        self.assertEqual(self.cache.get(path), [])
+
+    def test_eviction(self):
+        self.cache.max_entries = 2
+        paths = []
+        for i in range(3):
+            path = os.path.join(self.root, 'module%d.py' % i)
+            with open(path, 'w') as fh:
+                fh.write('import os\n')
+            paths.append(path)
+        for path in paths:
+            self.cache.set(path, False, ['os'])
+        self.cache._evict(self.cache._connect())
+        self.assertEqual([self.cache.get(x) for x in paths], [None, ['os'], ['os']])
+
+    def test_version(self):
+        path = self.write('import os\n', 1000)
+        self.cache.set(path, False, ['os'])
+        self.assertEqual(self.cache.get(path), ['os'])
 
+        # Written by another version of the parser.
+        conn = self.cache._connect()
+        conn.execute('PRAGMA user_version = 1')
+        self.cache._conn = None
+        self.assertEqual(self.cache.get(path), None)
+        self.assertEqual(conn.execute('SELECT count(*) FROM imports').fetchone()[0], 0)
@@ -0,0 +1,148 @@
+import shutil
+import tempfile
+
+from common import *
+
+from metatools.imports.graph import iter_dot, iter_modules
+from metatools.imports import index as index_module
+from metatools.imports.index import GraphIndex
+
+
+class Opts(object):
+
+    def __init__(self, **kwargs):
+        self.exclude = None
+        self.implied = True
+        self.jobs = None
+        self.__dict__.update(kwargs)
+
+
+class GraphTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write('pkg/__init__.py', 'from . import core\n')
+        self.write('pkg/core.py', 'from . import utils\nimport os\n')
+        self.write('pkg/utils.py', '')
+        self.write('pkg/gui.py', 'from .core import thing\ndef func():\n    from . import utils\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, source):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(source)
+
+
+class TestGraph(GraphTestCase):
+
+    def test_modules(self):
+        modules = [(module, imports) for path, module, imports in iter_modules(self.root)]
+        self.assertEqual(modules, [
+            ('pkg', ['pkg', 'pkg.core']),
+            ('pkg.core', ['pkg', 'pkg.utils', 'os']),
+            ('pkg.gui', ['pkg.core', 'pkg.core.thing', 'pkg', 'pkg.utils']),
+            ('pkg.utils', []),
+        ])
+
+    def test_dot(self):
+        dot = list(iter_dot(Opts(), [self.root]))
+        self.assertEqual(dot, [
+            'digraph {',
+            '\t"pkg" [style=filled]',
+            '\t"pkg" -> "pkg.core" []',
+            '\t"pkg.core" -> "pkg.utils" [constraint=false]',
+            '\t"pkg.gui" -> "pkg.core" [constraint=false]',
+            '\t"pkg.gui" -> "pkg.utils" [constraint=false]',
+            '\t"pkg" -> "pkg.gui" [style=dotted]',
+            '\t"pkg" -> "pkg.utils" [style=dotted]',
+            '}',
+        ])
+
+    def test_parallel(self):
+        self.assertEqual(
+            list(iter_dot(Opts(jobs=2), [self.root])),
+            list(iter_dot(Opts(), [self.root])),
+        )
+
+
+class TestGraphIndex(GraphTestCase):
+
+    def test_queries(self):
+
+        index = GraphIndex([self.root])
+        changed, removed = index.update()
+        self.assertEqual(len(changed), 4)
+        self.assertEqual(removed, [])
+        self.assertEqual(index.modules, set(['pkg', 'pkg.core', 'pkg.utils', 'pkg.gui']))
+
+        self.assertEqual(index.importers('pkg.utils'), set(['pkg', 'pkg.core', 'pkg.gui']))
+        self.assertEqual(index.importers('pkg.utils', transitive=False), set(['pkg.core', 'pkg.gui']))
+        self.assertEqual(index.imports('pkg.core', transitive=False), set(['pkg', 'pkg.utils']))
+        self.assertEqual(index.imports('pkg.utils'), set())
+        self.assertEqual(index.shortest_path('pkg', 'pkg.utils'), ['pkg', 'pkg.core', 'pkg.utils'])
+        self.assertEqual(index.shortest_path('pkg.utils', 'pkg'), None)
+
+    def test_update(self):
+
+        index_path = os.path.join(self.root, 'graph.idx')
+        index = GraphIndex([self.root])
+        index.update()
+        index.save(index_path)
+
+        index = GraphIndex.load(index_path)
+        self.assertEqual(index.update(), ([], []))
+
+        # Only the stat changed.
+        path = os.path.join(self.root, 'pkg', 'utils.py')
+        os.utime(path, (1000, 1000))
+        self.assertEqual(index.update(), ([], []))
+        self.assertEqual(index.files[path][1], 1000)
+
+        self.write('pkg/utils.py', 'from . import gui\n')
+        os.unlink(os.path.join(self.root, 'pkg', 'core.py'))
+        self.assertEqual(index.update(), ([path], [os.path.join(self.root, 'pkg', 'core.py')]))
+        self.assertEqual(index.shortest_path('pkg', 'pkg.core'), None)
+        self.assertEqual(index.importers('pkg.gui'), set(['pkg.utils']))
+
+    def test_update_packages(self):
+
+        self.write('pkg/sub/mod.py', 'from . import sibling\n')
+        index = GraphIndex([self.root])
+        index.update()
+        self.assertTrue('mod' in index.modules)
+
+        # Becoming a package renames everything within it.
+        self.write('pkg/sub/__init__.py', '')
+        changed, removed = index.update()
+        self.assertEqual(sorted(changed), [os.path.join(self.root, 'pkg', 'sub', x) for x in ('__init__.py', 'mod.py')])
+        self.assertTrue('pkg.sub.mod' in index.modules)
+        self.assertEqual(index.imports('pkg.sub.mod', transitive=False), set(['pkg.sub']))
+
+        os.unlink(os.path.join(self.root, 'pkg', 'sub', '__init__.py'))
+        changed, removed = index.update()
+        self.assertEqual(changed, [os.path.join(self.root, 'pkg', 'sub', 'mod.py')])
+        self.assertTrue('mod' in index.modules)
+
+    def test_update_vanished(self):
+
+        index = GraphIndex([self.root])
+        path = os.path.join(self.root, 'pkg', 'gui.py')
+        self.assertEqual(index_module._index_path((path + '.missing', None))[1], None)
+
+        # As if it were removed between the walk and reading it.
+        index_path = index_module._index_path
+        def _index_path(args):
+            if args[0] == path:
+                os.unlink(path)
+            return index_path(args)
+        index_module._index_path = _index_path
+        try:
+            changed, removed = index.update()
+        finally:
+            index_module._index_path = index_path
+        self.assertEqual(len(changed), 3)
+        self.assertFalse(path in index.files)
@@ -1,12 +1,22 @@
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import lib2to3.pygram
+from cStringIO import StringIO
+
 from common import *
 
 from metatools.imports.rewrite import rewrite
+from metatools.imports import rewrite as rewrite_module
 
 
 class TestImportRewrites(TestCase):
 
+    engine = 'regex'
+
     def assertRewrite(self, original, target, changes, module_name=None, *args):
-        new = rewrite(original, changes, module_name)
+        new = rewrite(original, changes, module_name, engine=self.engine)
         self.assertEqual(new, target, *args)
 
     def test_passthrough_abs(self):
@@ -74,3 +84,313 @@ class TestImportRewrites(TestCase):
             'a.b.mod',
         )
 
+
+    def test_longest_prefix(self):
+        self.assertRewrite(dedent('''
+            import a.b.c
+            a.b.c.func()
+            a.b.d.func()
+            a.e.func()
+        '''), dedent('''
+            import z.c
+            z.c.func()
+            y.d.func()
+            x.e.func()
+        '''), {
+            'a': 'x',
+            'a.b': 'y',
+            'a.b.c': 'z.c',
+        })
+
+    def test_prefilter_untouched(self):
+        src = dedent('''
+            import os,sys
+            from b import (c,
+                d)
+        ''')
+        self.assertRewrite(src, src, {'a': 'x'})
+
+    def test_prefilter_absolute(self):
+        self.assertEqual(rewrite('from . import c\n', {'x': 'y'}, 'a.b', absolute=True, engine=self.engine), 'from a import c\n')
+
+
+class TestStatements(TestCase):
+
+    def test_iter_statements(self):
+        src = dedent('''
+            import a
+            # About func.
+            @deco
+            @deco(
+                1)
+            def func():
+                pass
+
+                # Still indented.
+            if a:
+                pass
+            # Between clauses.
+            else:
+                pass
+            x = \"\"\"
+            y\"\"\"; z = 1
+        ''')
+        chunks = list(rewrite_module.iter_statements(StringIO(src).readline))
+        self.assertEqual(''.join(chunks), src)
+        self.assertEqual([x.splitlines()[-1] for x in chunks], [
+            'import a',
+            '    pass',
+            '    pass',
+            'y\"\"\"; z = 1',
+        ])
+
+    def test_iter_diff(self):
+        original = ''.join('line %d\n' % i for i in range(40))
+        refactored = original.replace('line 5\n', 'five\n').replace('line 12\n', '').replace('line 30\n', 'thirty\n')
+        pairs = [(original[:70], refactored[:68]), (original[70:], refactored[68:])]
+        self.assertEqual(''.join(x[0] for x in pairs), original)
+        self.assertEqual(''.join(x[1] for x in pairs), refactored)
+        self.assertEqual(
+            '\n'.join(rewrite_module.iter_diff(pairs, 'x.py')),
+            rewrite_module._diff_strings(original, refactored, 'x.py'),
+        )
+
+
+class TestParser(TestCase):
+
+    def test_print_function(self):
+        src = dedent('''
+            from __future__ import (absolute_import,
+                print_function)
+            import a
+            print(a.b, file=a.c)
+        ''')
+        self.assertTrue(rewrite_module.has_print_function(src))
+        self.assertFalse(rewrite_module.has_print_function('print_function = 1\n'))
+        expected = src.replace('a.', 'x.').replace('import a', 'import x')
+        self.assertEqual(rewrite(src, {'a': 'x'}, engine='tree'), expected)
+
+        # Streaming must remember it from the first statement.
+        chunks = rewrite_module.iter_statements(StringIO(src).readline)
+        pairs = list(rewrite_module.iter_rewrite(chunks, {'a': 'x'}, engine='tree'))
+        self.assertEqual(''.join(x[1] for x in pairs), expected)
+
+    def test_encoding(self):
+        self.assertEqual(rewrite_module._detect_encoding('import a\n'), 'utf-8')
+        self.assertEqual(rewrite_module._detect_encoding('# -*- coding: latin-1 -*-\nimport a\n'), 'iso-8859-1')
+
+    def test_threads(self):
+
+        parser = rewrite_module.Parser(size=2)
+        sources = ['import a\na.func(%d)\n' % i for i in range(200)]
+        expected = [x.replace('a', 'x') for x in sources]
+        results = {}
+
+        def target(i):
+            results[i] = [rewrite(x, {'a': 'x'}, parser=parser) for x in sources]
+
+        threads = [threading.Thread(target=target, args=(i, )) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, dict((i, expected) for i in range(4)))
+        self.assertTrue(len(parser._idle[lib2to3.pygram.python_grammar]) <= 2)
+
+
+class TestTreeImportRewrites(TestImportRewrites):
+
+    engine = 'tree'
+
+    def test_preserves_formatting(self):
+        self.assertRewrite(dedent('''
+            from a import (b, # The first.
+                c as d)
+            import  a.b ,os
+            @a.deco
+            def func(): return foo().a.b + a ** a
+        '''), dedent('''
+            from x import (b, # The first.
+                c as d)
+            import  x.b ,os
+            @x.deco
+            def func(): return foo().a.b + x ** x
+        '''), {
+            'a': 'x',
+        })
+
+
+class TestBatch(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write('pkg/__init__.py', '')
+        self.write('pkg/b.py', 'import a\na.func()\n')
+        self.write('pkg/a.py', 'import os\n')
+        self.write('pkg/.hidden/c.py', 'import a\n')
+        self.write('pkg/broken.py', 'import a\ndef (\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, source):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(source)
+
+    def test_iter_paths(self):
+        pkg = os.path.join(self.root, 'pkg')
+        self.assertEqual(list(rewrite_module.iter_paths([pkg, os.path.join(pkg, 'a.py')])), [
+            os.path.join(pkg, x) for x in ('__init__.py', 'a.py', 'b.py', 'broken.py')
+        ])
+
+    def test_process(self):
+
+        paths = list(rewrite_module.iter_paths([self.root]))
+        init_args = ({'a': 'x'}, {})
+
+        rewrite_module._init_worker(*init_args)
+        results = map(rewrite_module.process_path, paths)
+
+        pool = multiprocessing.Pool(2, rewrite_module._init_worker, init_args)
+        try:
+            self.assertEqual(pool.map(rewrite_module.process_path, paths), results)
+        finally:
+            pool.terminate()
+
+        by_name = dict((os.path.basename(x[0]), x) for x in results)
+        self.assertEqual(by_name['a.py'][2:], (None, None, None, None))
+        self.assertEqual(by_name['b.py'][3], 'import x\nx.func()\n')
+        self.assertTrue(by_name['broken.py'][4])
+
+        path = by_name['b.py'][0]
+        rewrite_module.write_atomic(path, by_name['b.py'][3])
+        self.assertEqual(open(path).read(), 'import x\nx.func()\n')
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))), [
+            '.hidden', '__init__.py', 'a.py', 'b.py', 'broken.py',
+        ])
+
+    def test_plan(self):
+
+        self.write('pkg/c.py', 'import os\n\nimport a\n\n\ndef func():\n    value = a.func()\n\n')
+        rewrite_module._init_worker({'a': 'x'}, {})
+        results = map(rewrite_module.process_path, rewrite_module.iter_paths([self.root]))
+        files = dict((x[0], x[5]) for x in results if x[5])
+        by_name = dict((os.path.basename(x[0]), x) for x in results)
+        self.assertEqual(sorted(os.path.basename(x) for x in files), ['b.py', 'c.py'])
+
+        c_path = by_name['c.py'][0]
+        self.assertEqual(files[c_path][1], [
+            (2, 3, 'import x\n'),
+            (6, 7, '    value = x.func()\n'),
+        ])
+
+        plan_path = os.path.join(self.root, 'plan.json')
+        rewrite_module.save_plan(plan_path, {'a': 'x'}, files)
+        mapping, loaded = rewrite_module.load_plan(plan_path)
+        self.assertEqual(mapping, {'a': 'x'})
+        self.assertEqual(loaded, files)
+
+        # Someone edits one file after planning.
+        b_path = by_name['b.py'][0]
+        self.write('pkg/b.py', 'import a\n')
+
+        applied, refused = rewrite_module.apply_plan(loaded)
+        self.assertEqual(applied, [c_path])
+        self.assertEqual(refused, [b_path])
+        self.assertEqual(open(c_path).read(), by_name['c.py'][3])
+        self.assertEqual(open(b_path).read(), 'import a\n')
+
+    def test_edits(self):
+        original = 'a\nb\nc\nd\n'
+        for refactored in ('a\nc\nd\n', 'x\ny\nb\nc\nd\nz\n', '', 'a\nb\nc\nd\n'):
+            edits = rewrite_module.make_edits(original, refactored)
+            self.assertEqual(rewrite_module.apply_edits(original, edits), refactored)
+
+    def test_cache(self):
+
+        cache_path = os.path.join(self.root, 'cache')
+        paths = list(rewrite_module.iter_paths([self.root]))
+        rewrite_module._init_worker({'a': 'x'}, {}, cache_path)
+        results = map(rewrite_module.process_path, paths)
+
+        # One entry per file which parsed.
+        entries = [x for d in os.listdir(cache_path) for x in os.listdir(os.path.join(cache_path, d))]
+        self.assertEqual(len(entries), 3)
+
+        rewrite = rewrite_module.rewrite
+        def fail(*args, **kwargs):
+            raise RuntimeError('should be cached')
+        rewrite_module.rewrite = fail
+        try:
+            cached = map(rewrite_module.process_path, paths)
+        finally:
+            rewrite_module.rewrite = rewrite
+
+        # Everything but the broken file.
+        self.assertEqual(cached[:-1], results[:-1])
+        self.assertTrue(cached[-1][4])
+
+        # Different options miss.
+        rewrite_module._init_worker({'a': 'x'}, {'engine': 'tree'}, cache_path)
+        self.assertEqual(map(rewrite_module.process_path, paths)[:-1], results[:-1])
+        entries = [x for d in os.listdir(cache_path) for x in os.listdir(os.path.join(cache_path, d))]
+        self.assertEqual(len(entries), 6)
+
+    def test_stream(self):
+
+        self.write('pkg/c.py', 'import os\n\nimport a\n\n\ndef func():\n    value = a.func()\n\n')
+        paths = list(rewrite_module.iter_paths([self.root]))
+        rewrite_module._init_worker({'a': 'x'}, {})
+        results = map(rewrite_module.process_path, paths)
+
+        rewrite_module._init_worker({'a': 'x'}, {}, stream=True, write=True)
+        for result, streamed in zip(results, map(rewrite_module.process_path, paths)):
+            path, lines, diff, refactored, error, plan = result
+            self.assertEqual(streamed[0], path)
+            if error:
+                self.assertTrue(streamed[4])
+                continue
+            self.assertEqual(streamed[1], lines)
+            self.assertEqual(streamed[5], plan)
+            if diff is None:
+                self.assertEqual(streamed[2], None)
+                continue
+            self.assertEqual(open(streamed[2]).read(), diff + '\n')
+            os.unlink(streamed[2])
+            self.assertEqual(open(path).read(), refactored)
+
+        # Nothing is left behind.
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'pkg'))), [
+            '.hidden', '__init__.py', 'a.py', 'b.py', 'broken.py', 'c.py',
+        ])
+
+    def test_stream_whitespace(self):
+
+        # Whitespace changes are only kept alongside others, in both modes.
+        def rewrite_(source, mapping, module_name=None, **kwargs):
+            return source.replace('pass\n', 'pass \n').replace('a.func', 'x.func')
+
+        self.write('pkg/d.py', 'def func():\n    pass\n')
+        self.write('pkg/e.py', 'def func():\n    pass\n\n\nvalue = a.func()\n')
+        paths = [os.path.join(self.root, 'pkg', x) for x in ('d.py', 'e.py')]
+
+        rewrite_module.rewrite = rewrite_
+        try:
+            rewrite_module._init_worker({'a': 'x'}, {})
+            results = map(rewrite_module.process_path, paths)
+            rewrite_module._init_worker({'a': 'x'}, {}, stream=True, write=True)
+            streamed = map(rewrite_module.process_path, paths)
+        finally:
+            rewrite_module.rewrite = rewrite
+
+        self.assertEqual([x[2] for x in results[:1] + streamed[:1]], [None, None])
+        self.assertEqual(open(paths[0]).read(), 'def func():\n    pass\n')
+        self.assertEqual(results[1][3], 'def func():\n    pass \n\n\nvalue = x.func()\n')
+        self.assertEqual(open(paths[1]).read(), results[1][3])
+        self.assertEqual(open(streamed[1][2]).read(), results[1][2] + '\n')
+        self.assertEqual(streamed[1][5], results[1][5])
+        os.unlink(streamed[1][2])
@@ -0,0 +1,117 @@
+import shutil
+import tempfile
+import time
+
+from common import *
+
+from metatools.imports import watch
+from metatools.imports.watch import get_watcher, PollingWatcher, InotifyWatcher
+
+
+class WatcherTests(object):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'module.py')
+        self.touch(1000)
+        self.watcher = self.get_watcher()
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.root)
+
+    def touch(self, mtime, path=None):
+        path = path or self.path
+        with open(path, 'w') as fh:
+            fh.write('# %s\n' % mtime)
+        os.utime(path, (mtime, mtime))
+
+    def test_dirty(self):
+
+        self.watcher.watch(self.path)
+        self.assertTrue(self.path in self.watcher)
+        self.assertFalse(self.watcher.pop_dirty(self.path))
+        generation = self.watcher.generation
+
+        self.touch(2000)
+        self.wait()
+        self.assertTrue(self.watcher.generation > generation)
+        self.assertTrue(self.watcher.pop_dirty(self.path))
+        self.assertFalse(self.watcher.pop_dirty(self.path))
+
+    def test_unwatched(self):
+
+        other = os.path.join(self.root, 'other.py')
+        self.touch(1000, other)
+        self.watcher.watch(other)
+
+        self.touch(2000)
+        self.touch(2000, other)
+        self.wait()
+
+        self.assertFalse(self.path in self.watcher)
+        self.assertFalse(self.watcher.pop_dirty(self.path))
+        self.assertTrue(self.watcher.pop_dirty(other))
+
+
+class TestPollingWatcher(WatcherTests, TestCase):
+
+    def get_watcher(self):
+        return PollingWatcher(interval=3600)
+
+    def wait(self):
+        self.watcher.poll()
+
+
+class TestInotifyWatcher(WatcherTests, TestCase):
+
+    def get_watcher(self):
+        return get_watcher('inotify')
+
+    def wait(self):
+        timeout = time.time() + 5
+        while time.time() < timeout and not self.watcher._dirty:
+            time.sleep(0.01)
+
+    def test_directory_removed(self):
+
+        directory = os.path.join(self.root, 'sub')
+        path = os.path.join(directory, 'module.py')
+        os.makedirs(directory)
+        self.touch(1000, path)
+        self.watcher.watch(path)
+
+        shutil.rmtree(directory)
+        timeout = time.time() + 5
+        while time.time() < timeout and path in self.watcher:
+            time.sleep(0.01)
+        self.assertFalse(path in self.watcher)
+
+        # Watched again (as reload._is_outdated would) once it is back.
+        os.makedirs(directory)
+        self.touch(2000, path)
+        self.watcher.watch(path)
+        self.assertTrue(path in self.watcher)
+        self.touch(3000, path)
+        self.wait()
+        self.assertTrue(self.watcher.pop_dirty(path))
+
+    def test_network_polled(self):
+
+        is_network_path = watch.is_network_path
+        watch.is_network_path = lambda path: True
+        try:
+            self.watcher.watch(self.path)
+        finally:
+            watch.is_network_path = is_network_path
+
+        # Other hosts' changes don't raise events; this must be polled.
+        self.assertTrue(self.path in self.watcher)
+        self.assertEqual(self.watcher._directories, {})
+        self.touch(2000)
+        self.watcher.poll()
+        self.assertTrue(self.watcher.pop_dirty(self.path))
+
+
+if not sys.platform.startswith('linux'):
+    del TestInotifyWatcher
@@ -0,0 +1,67 @@
+import time
+from unittest import skipIf
+
+from common import *
+
+from metatools.git import BlobReader, NULL_SHA
+from metatools.lint import git_pre_recieve as hook
+
+from test_git import GitTestCase
+
+try:
+    import pyflakes
+except ImportError:
+    pyflakes = None
+
+
+class TestPreReceive(GitTestCase):
+
+    def test_new_messages(self):
+        old = [(1, "'os' imported but unused"), (5, "undefined name 'x'")]
+        new = [(2, "'os' imported but unused"), (6, "undefined name 'x'"), (7, "undefined name 'x'")]
+        self.assertEqual(hook.new_messages(old, new), [(7, "undefined name 'x'")])
+        self.assertEqual(hook.new_messages([], new), new)
+
+    def test_iter_tasks(self):
+        with BlobReader(self.root) as reader:
+            cwd = os.getcwd()
+            os.chdir(self.root)
+            try:
+                tasks = list(hook.iter_tasks(reader, [
+                    (self.first, self.second, 'refs/heads/master'),
+                    (NULL_SHA, self.first, 'refs/heads/new'),
+                ]))
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(tasks, [
+            ('refs/heads/master', 'pkg/b.py', 'import os\n', 'import a\n'),
+            ('refs/heads/master', 'pkg/c.py', None, 'from a import func\n'),
+            ('refs/heads/master', 'scripts/d.py', None, 'import a\n'),
+            ('refs/heads/new', 'pkg/__init__.py', None, ''),
+            ('refs/heads/new', 'pkg/a.py', None, 'import a\na.func()\n'),
+            ('refs/heads/new', 'pkg/b.py', None, 'import os\n'),
+        ])
+
+    @skipIf(pyflakes is None, 'pyflakes is not installed')
+    def test_check_task(self):
+        ref_name, filename, messages = hook._check_task(('ref', 'pkg/b.py', 'import os\n', 'import os\nimport sys\n'))
+        self.assertEqual(messages, [(2, "'sys' imported but unused")])
+
+    @skipIf(pyflakes is None, 'pyflakes is not installed')
+    def test_check_task_error(self):
+        ref_name, filename, messages = hook._check_task(('ref', 'pkg/b.py', None, 'import os\0\n'))
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0][1].startswith('could not check: TypeError'))
+
+    def test_iter_results_window(self):
+
+        consumed = []
+        def tasks():
+            for i in range(20):
+                consumed.append(i)
+                yield ('ref', 'file%d.py' % i, None, 'x = %d\n' % i)
+
+        results = hook._iter_results(tasks(), 2, time.time() + 60)
+        next(results)
+        self.assertEqual(len(consumed), 4)
+        self.assertEqual(len(list(results)), 19)
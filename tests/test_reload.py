@@ -0,0 +1,318 @@
+import json
+import shutil
+import signal
+import tempfile
+import time
+
+from common import *
+
+from metatools.imports.reload import autoreload, throttled_autoreload, use_watcher, add_listener, remove_listener, _iter_components
+from metatools.imports.trace import ChromeTrace
+from metatools.imports.watch import PollingWatcher
+from metatools.imports.reload import _dependency_lists, _reload_times
+
+reload_module = sys.modules['metatools.imports.reload']
+
+
+class TestComponents(TestCase):
+
+    def test_chain(self):
+        edges = {'a': ['b'], 'b': ['c'], 'c': []}
+        self.assertEqual(list(_iter_components('a', edges)), [['c'], ['b'], ['a']])
+
+    def test_cycle(self):
+        edges = {
+            'pkg': ['pkg.core'],
+            'pkg.core': ['pkg', 'pkg.utils'],
+            'pkg.utils': [],
+            'main': ['pkg', 'pkg.utils'],
+        }
+        components = list(_iter_components('main', edges))
+        self.assertEqual(components[0], ['pkg.utils'])
+        self.assertEqual(sorted(components[1]), ['pkg', 'pkg.core'])
+        self.assertEqual(components[2], ['main'])
+
+
+class TestAutoreload(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = True
+        sys.path.insert(0, self.root)
+        self.mtime = time.time() - 100
+        self.write('reload_log.py', 'calls = []\n')
+
+    def tearDown(self):
+        sys.path.remove(self.root)
+        sys.dont_write_bytecode = self.dont_write_bytecode
+        for name, module in list(sys.modules.items()):
+            if (getattr(module, '__file__', None) or '').startswith(self.root):
+                del sys.modules[name]
+                _dependency_lists.pop(name, None)
+                _reload_times.pop(name, None)
+                reload_module._throttled_checks.pop(name, None)
+        shutil.rmtree(self.root)
+
+    def write(self, name, source):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(source)
+        self.mtime += 10
+        os.utime(path, (self.mtime, self.mtime))
+
+    def write_module(self, name, imports=''):
+        self.write(name, 'import reload_log\nreload_log.calls.append(__name__)\n' + imports)
+
+    def calls(self):
+        import reload_log
+        calls = list(reload_log.calls)
+        del reload_log.calls[:]
+        return calls
+
+    def test_chain(self):
+
+        self.write_module('rl_chain_a.py', 'import rl_chain_b\n')
+        self.write_module('rl_chain_b.py', 'import rl_chain_c\n')
+        self.write_module('rl_chain_c.py')
+        import rl_chain_a
+        self.calls()
+
+        self.assertFalse(autoreload(rl_chain_a))
+        self.assertEqual(self.calls(), [])
+
+        self.write_module('rl_chain_c.py')
+        self.assertTrue(autoreload(rl_chain_a))
+        self.assertEqual(self.calls(), ['rl_chain_c', 'rl_chain_b', 'rl_chain_a'])
+
+        self.assertFalse(autoreload(rl_chain_a))
+        self.assertEqual(self.calls(), [])
+
+    def test_listener(self):
+
+        self.write_module('rl_listen_a.py', 'import rl_listen_b\n')
+        self.write_module('rl_listen_b.py', 'def __before_reload__():\n    return 1\n')
+        import rl_listen_a
+        autoreload(rl_listen_a)
+
+        trace = ChromeTrace()
+        add_listener(trace)
+        try:
+            self.write_module('rl_listen_b.py')
+            autoreload(rl_listen_a)
+        finally:
+            remove_listener(trace)
+
+        events = [(x['cat'], x['args']['module']) for x in trace.events]
+        self.assertEqual(events[-1], ('cycle', 'rl_listen_a'))
+        self.assertTrue(('outdated', 'rl_listen_b') in events)
+        self.assertTrue(('before_reload', 'rl_listen_b') in events)
+        self.assertTrue(events.index(('reload', 'rl_listen_b')) < events.index(('reload', 'rl_listen_a')))
+        self.assertTrue(('graph', 'rl_listen_a') in events)
+        self.assertEqual(sorted(n for t, n in trace.summarize()), ['rl_listen_a', 'rl_listen_b'])
+
+        path = os.path.join(self.root, 'trace.json')
+        trace.save(path)
+        with open(path) as fh:
+            self.assertEqual(len(json.load(fh)['traceEvents']), len(events))
+
+    def test_trace_bounded(self):
+
+        self.write_module('rl_bounded.py')
+        import rl_bounded
+        autoreload(rl_bounded)
+
+        trace = ChromeTrace(max_events=5)
+        add_listener(trace)
+        try:
+            # Cycles which reload nothing are dropped.
+            autoreload(rl_bounded)
+            self.assertEqual(list(trace.events), [])
+            for i in range(3):
+                self.write_module('rl_bounded.py')
+                autoreload(rl_bounded)
+        finally:
+            remove_listener(trace)
+
+        events = [x['cat'] for x in trace.events]
+        self.assertEqual(len(events), 5)
+        self.assertEqual(events[-1], 'cycle')
+        self.assertTrue('reload' in events)
+
+    def test_throttled(self):
+
+        self.write_module('rl_throttle_a.py', 'import rl_throttle_b\n')
+        self.write_module('rl_throttle_b.py')
+        import rl_throttle_a
+        self.calls()
+        self.assertFalse(throttled_autoreload(rl_throttle_a, interval=3600))
+
+        # Nothing has changed, so nothing is even checked.
+        trace = ChromeTrace(idle_cycles=True)
+        add_listener(trace)
+        try:
+            self.assertFalse(throttled_autoreload(rl_throttle_a, interval=3600))
+        finally:
+            remove_listener(trace)
+        self.assertEqual(list(trace.events), [])
+
+        self.write_module('rl_throttle_b.py')
+        if reload_module._watcher is None:
+            # Not noticed until the interval has passed.
+            self.assertFalse(throttled_autoreload(rl_throttle_a, interval=3600))
+            self.assertTrue(throttled_autoreload(rl_throttle_a, interval=0))
+        else:
+            # The watcher knows it has changed.
+            self.assertTrue(throttled_autoreload(rl_throttle_a, interval=3600))
+        self.assertEqual(self.calls(), ['rl_throttle_b', 'rl_throttle_a'])
+        self.assertFalse(throttled_autoreload(rl_throttle_a, interval=3600))
+
+    def test_throttled_unwatched(self):
+
+        if reload_module._watcher is not None:
+            self.skipTest('needs its own watcher')
+
+        class DroppingWatcher(PollingWatcher):
+            # As InotifyWatcher does when it can't add a watch.
+            def _watch(self, path):
+                self._paths.discard(path)
+
+        self.write_module('rl_unwatched.py')
+        import rl_unwatched
+        self.calls()
+
+        use_watcher(DroppingWatcher(interval=3600))
+        try:
+            self.assertFalse(throttled_autoreload(rl_unwatched, interval=3600))
+            self.write_module('rl_unwatched.py')
+            self.assertFalse(throttled_autoreload(rl_unwatched, interval=3600))
+            self.assertTrue(throttled_autoreload(rl_unwatched, interval=0))
+            self.assertEqual(self.calls(), ['rl_unwatched'])
+        finally:
+            use_watcher(None)
+
+    def test_unaffected_sibling(self):
+
+        self.write_module('rl_sib_a.py', 'import rl_sib_b\nimport rl_sib_c\n')
+        self.write_module('rl_sib_b.py')
+        self.write_module('rl_sib_c.py')
+        import rl_sib_a
+        autoreload(rl_sib_a)
+        self.calls()
+
+        self.write_module('rl_sib_c.py')
+        autoreload(rl_sib_a)
+        self.assertEqual(self.calls(), ['rl_sib_c', 'rl_sib_a'])
+
+    def test_cycle(self):
+
+        self.write_module('rl_cycle/__init__.py', 'from . import core\n')
+        self.write_module('rl_cycle/core.py', 'from . import utils\n')
+        self.write_module('rl_cycle/utils.py')
+        self.write_module('rl_cycle_main.py', 'import rl_cycle\n')
+        import rl_cycle_main
+        autoreload(rl_cycle_main)
+        self.calls()
+
+        self.write_module('rl_cycle/utils.py')
+        autoreload(rl_cycle_main)
+        calls = self.calls()
+        self.assertEqual(calls[0], 'rl_cycle.utils')
+        self.assertEqual(sorted(calls[1:3]), ['rl_cycle', 'rl_cycle.core'])
+        self.assertEqual(calls[3:], ['rl_cycle_main'])
+
+    def test_previously_reloaded_dependency(self):
+
+        self.write_module('rl_prev_a.py', 'import rl_prev_c\n')
+        self.write_module('rl_prev_b.py', 'import rl_prev_c\n')
+        self.write_module('rl_prev_c.py')
+        import rl_prev_a
+        import rl_prev_b
+        autoreload(rl_prev_a)
+        autoreload(rl_prev_b)
+        self.calls()
+
+        self.write_module('rl_prev_c.py')
+        autoreload(rl_prev_a)
+        self.assertEqual(self.calls(), ['rl_prev_c', 'rl_prev_a'])
+
+        # The shared dependency was reloaded by the other module's cycle.
+        time.sleep(0.01)
+        autoreload(rl_prev_b)
+        self.assertEqual(self.calls(), ['rl_prev_b'])
+
+
+class TestWatchedAutoreload(TestAutoreload):
+
+    def setUp(self):
+        self.watcher = use_watcher('poll', interval=3600)
+        super(TestWatchedAutoreload, self).setUp()
+
+    def tearDown(self):
+        use_watcher(None)
+        super(TestWatchedAutoreload, self).tearDown()
+
+    def write(self, name, source):
+        super(TestWatchedAutoreload, self).write(name, source)
+        self.watcher.poll()
+
+    def test_fork(self):
+
+        self.write_module('rl_wfork.py')
+        import rl_wfork
+        self.assertFalse(autoreload(rl_wfork))
+
+        pid = os.fork()
+        if not pid:
+            # Nothing would tell the inherited watcher about this.
+            ok = False
+            try:
+                TestAutoreload.write(self, 'rl_wfork.py', 'import reload_log\n')
+                ok = autoreload(rl_wfork)
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+
+class TestParallelStatAutoreload(TestAutoreload):
+
+    def setUp(self):
+        self.stat_threads = reload_module._STAT_THREADS
+        reload_module._STAT_THREADS = 2
+        super(TestParallelStatAutoreload, self).setUp()
+
+    def tearDown(self):
+        reload_module._STAT_THREADS = self.stat_threads
+        super(TestParallelStatAutoreload, self).tearDown()
+
+    def test_stat_modules(self):
+        self.write_module('rl_stat_a.py')
+        self.write_module('rl_stat_b.py')
+        self.write_module('rl_stat_c.py')
+        import rl_stat_a, rl_stat_b, rl_stat_c
+        mtimes = reload_module._stat_modules([rl_stat_a, rl_stat_b, rl_stat_c, sys])
+        self.assertEqual(mtimes, dict(
+            (x.__file__, os.path.getmtime(x.__file__)) for x in (rl_stat_a, rl_stat_b, rl_stat_c)
+        ))
+        self.assertTrue(reload_module._stat_pool is not None)
+
+    def test_stat_after_fork(self):
+        self.write_module('rl_fork_a.py')
+        self.write_module('rl_fork_b.py')
+        self.write_module('rl_fork_c.py')
+        import rl_fork_a, rl_fork_b, rl_fork_c
+        modules = [rl_fork_a, rl_fork_b, rl_fork_c]
+        reload_module._stat_modules(modules)
+        pid = os.fork()
+        if not pid:
+            # The parent's pool has no threads in here; it would hang.
+            signal.alarm(5)
+            try:
+                reload_module._stat_modules(modules)
+            finally:
+                os._exit(0 if reload_module._stat_pool_pid == os.getpid() else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)